@@ -1,6 +1,19 @@
 import feedparser
-import re
 import numpy as np
+import os
+import sys
+
+try:
+    from tokenizer import Tokenizer, strip_html
+except ImportError:
+    # run from the chapter directory without the repository root
+    # on PYTHONPATH, so look for the shared tokenizer one level up
+    sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..'))
+    from tokenizer import Tokenizer, strip_html
+
+# words longer than 3 chars
+news_words = Tokenizer(min_length=4)
 
 feed_list = ['http://today.reuters.com/rss/topNews',
             'http:/today.reuters.com/rss/domesticNews',
@@ -20,29 +33,11 @@ feed_list = ['http://today.reuters.com/rss/topNews',
             'http://rss.cnn.com/rss/edition_us.rss']
 
 
-def strip_html(h):
-    '''
-    Iterate over each character in h and strips anything between < and >.
-    '''
-    p = ''
-    s = 0
-    for c in h:
-        if c == '<':
-            s = 1
-        elif c == '>':
-            s = 0
-            p += ' '
-        elif s == 0:
-            p += c
-    return p
-
-
 def separate_words(text):
     '''
     Separates text into a list of lower cased strings.
     '''
-    splitter = re.compile('\\W*')
-    return [s.lower() for s in splitter.split(text) if len(s) > 3]
+    return list(news_words(text))
 
 
 def get_article_words(get_text=False):
@@ -0,0 +1,221 @@
+'''
+Benchmarks the recommendation functions at several sizes and emits
+the results as JSON, eg.
+
+    python benchmark.py --scales 100x200 943x1682 --output results.json
+    python benchmark.py --movie-lens ml-100k/
+
+Every function runs twice: on the nested dict path (a similarity function
+RatingMatrix doesn't know, so the original pure Python code runs) and on
+the array path (RatingMatrix, NeighborIndex). Each run happens in its own
+process so the reported peak RSS belongs to that run alone.
+'''
+import argparse
+import json
+import multiprocessing
+import Queue
+import resource
+import sys
+import time
+
+import numpy as np
+
+import recommendations
+from neighbors import NeighborIndex
+from ratings import RatingMatrix
+
+FUNCTIONS = ['top_matches', 'get_recommendations', 'calculate_similar_items',
+             'get_recommended_items']
+PATHS = ['dict', 'matrix']
+
+
+def dict_sim_distance(prefs, person1, person2):
+    '''
+    sim_distance hidden from SIMILARITY_METRICS, which forces the
+    original per-pair code path.
+    '''
+    return recommendations.sim_distance(prefs, person1, person2)
+
+
+def synthetic_prefs(users, items, per_user=50, seed=0):
+    '''
+    Random prefs dict with users x items and about per_user ratings
+    (whole stars from 1 to 5) per user.
+    '''
+    random = np.random.RandomState(seed)
+    prefs = {}
+    for user in xrange(users):
+        rated = random.choice(items, min(per_user, items), replace=False)
+        stars = random.randint(1, 6, len(rated)).astype(float)
+        prefs['user%d' % user] = dict(('item%d' % item, star) for item, star
+                                      in zip(rated.tolist(), stars.tolist()))
+    return prefs
+
+
+def latencies(fn, arguments):
+    '''
+    Calls fn once per set of arguments, returns the wall time of each call.
+    '''
+    times = []
+    for args in arguments:
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return times
+
+
+def run_case(prefs, function, path, queries, n):
+    '''
+    Runs one function on one path and returns its timings.
+    '''
+    if path == 'matrix':
+        prefs = RatingMatrix.from_prefs(prefs)
+        similarity_fn = recommendations.sim_distance
+    else:
+        similarity_fn = dict_sim_distance
+
+    random = np.random.RandomState(1)
+    people = list(prefs)
+    sample = [people[i] for i in random.choice(len(people),
+                                               min(queries, len(people)),
+                                               replace=False)]
+
+    if function == 'top_matches':
+        times = latencies(recommendations.top_matches,
+                          [(prefs, person, n, similarity_fn)
+                           for person in sample])
+    elif function == 'get_recommendations':
+        times = latencies(recommendations.get_recommendations,
+                          [(prefs, person, similarity_fn)
+                           for person in sample])
+    elif function == 'calculate_similar_items':
+        times = latencies(recommendations.calculate_similar_items,
+                          [(prefs, n, similarity_fn)])
+    elif function == 'get_recommended_items':
+        item_match = recommendations.calculate_similar_items(prefs, n,
+                                                             similarity_fn)
+        if path == 'matrix':
+            item_match = NeighborIndex.from_item_match(item_match)
+        times = latencies(recommendations.get_recommended_items,
+                          [(prefs, item_match, person) for person in sample])
+    else:
+        raise ValueError('Unknown function: %s' % function)
+
+    return times
+
+
+def child(queue, load, function, path, queries, n):
+    try:
+        prefs = load()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = run_case(prefs, function, path, queries, n)
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception as e:
+        queue.put({'function': function, 'path': path,
+                   'error': '%s: %s' % (type(e).__name__, e)})
+        return
+
+    p50, p90, p99 = np.percentile(np.array(times) * 1000, [50, 90, 99])
+    queue.put({'function': function, 'path': path, 'wall_s': sum(times),
+               'calls': len(times), 'p50_ms': p50, 'p90_ms': p90,
+               'p99_ms': p99, 'rss_before_kb': rss_before,
+               'rss_peak_kb': rss_peak})
+
+
+def run(datasets, functions=FUNCTIONS, paths=PATHS, queries=50, n=10):
+    '''
+    Runs every function on every path for every (name, load) dataset,
+    each in a fresh process. load is a function returning a prefs dict.
+    Returns a list of result dicts.
+    '''
+    results = []
+    for name, load in datasets:
+        for function in functions:
+            for path in paths:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(
+                        target=child,
+                        args=(queue, load, function, path, queries, n))
+                process.start()
+                result = wait_for_result(queue, process)
+                process.join()
+
+                result.update(dataset=name, function=function, path=path)
+                results.append(result)
+                if 'error' in result:
+                    print >> sys.stderr, '%s %s %s: failed, %s' % (
+                            name, function, path, result['error'])
+                    continue
+                print >> sys.stderr, ('%s %s %s: %.3f s, p50 %.2f ms, '
+                                      'peak RSS %d KB' % (
+                        name, function, path, result['wall_s'],
+                        result['p50_ms'], result['rss_peak_kb']))
+    return results
+
+
+def wait_for_result(queue, process, poll=1.0):
+    '''
+    Waits for the result child puts on queue. If the process dies
+    without one (killed, out of memory, ...), returns an error record
+    instead of waiting forever.
+    '''
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            if not process.is_alive():
+                # the result may have arrived just before it exited
+                try:
+                    return queue.get(timeout=poll)
+                except Queue.Empty:
+                    return {'error': 'process exited with code %s' %
+                                     process.exitcode}
+
+
+class SyntheticLoader(object):
+    def __init__(self, users, items, per_user):
+        self.users = users
+        self.items = items
+        self.per_user = per_user
+
+    def __call__(self):
+        return synthetic_prefs(self.users, self.items, self.per_user)
+
+
+class MovieLensLoader(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        return recommendations.load_movie_lens(self.path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scales', nargs='*', default=['100x200', '943x1682'],
+                        help='synthetic sizes as USERSxITEMS')
+    parser.add_argument('--per-user', type=int, default=50,
+                        help='ratings per synthetic user')
+    parser.add_argument('--movie-lens', help='path to a MovieLens directory')
+    parser.add_argument('--functions', nargs='*', default=FUNCTIONS)
+    parser.add_argument('--paths', nargs='*', default=PATHS)
+    parser.add_argument('--queries', type=int, default=50,
+                        help='people sampled for per-query latencies')
+    parser.add_argument('-n', type=int, default=10)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    datasets = []
+    for scale in args.scales:
+        users, items = [int(size) for size in scale.split('x')]
+        datasets.append(('synthetic-%s' % scale,
+                         SyntheticLoader(users, items, args.per_user)))
+    if args.movie_lens:
+        datasets.append(('movie-lens', MovieLensLoader(args.movie_lens)))
+
+    results = run(datasets, args.functions, args.paths, args.queries, args.n)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print json.dumps(results, indent=2)
@@ -0,0 +1,194 @@
+import numpy as np
+from scipy import sparse
+
+from ratings import RatingMatrix, label_array
+
+
+class FactorModel(object):
+    '''
+    Latent factor recommender trained with alternating least squares.
+    Every user and every item gets a vector of factors, and a rating
+    is predicted as the global mean rating plus the dot product of the
+    user's and the item's factors. That makes a top-n query for a user
+    a single matrix-vector product over all the item factors, instead
+    of the similarity work the neighborhood methods need.
+    '''
+    def __init__(self, factors=20, regularization=0.1, iterations=10,
+                 seed=None):
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.random = np.random.RandomState(seed)
+
+        self.users = []
+        self.items = []
+        self.user_index = {}
+        self.item_index = {}
+        self.user_factors = None
+        self.item_factors = None
+        self.mean = 0.0
+        self.rated = None
+
+    def fit(self, prefs, warm_start=False, iterations=None):
+        '''
+        Trains the model on prefs (a nested dict or a RatingMatrix).
+        With warm_start=True, users and items the model already knows
+        keep their current factors as the starting point, so retraining
+        after new ratings arrive needs only a few iterations.
+        '''
+        if not isinstance(prefs, RatingMatrix):
+            prefs = RatingMatrix.from_prefs(prefs)
+        if iterations is None:
+            iterations = self.iterations
+
+        user_factors = self.initial_factors(prefs.users, self.user_index,
+                                            self.user_factors, warm_start)
+        item_factors = self.initial_factors(prefs.items, self.item_index,
+                                            self.item_factors, warm_start)
+
+        self.users = prefs.users
+        self.items = prefs.items
+        self.user_index = prefs.user_index
+        self.item_index = prefs.item_index
+        self.mean = prefs.csr.data.mean() if prefs.csr.nnz else 0.0
+        self.rated = prefs.csr
+
+        # factors are fitted to the ratings minus the global mean
+        by_user = prefs.csr.copy()
+        by_user.data -= self.mean
+        by_item = by_user.T.tocsr()
+
+        for i in xrange(iterations):
+            self.solve(by_user, item_factors, user_factors)
+            self.solve(by_item, user_factors, item_factors)
+
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        return self
+
+    def initial_factors(self, labels, old_index, old_factors, warm_start):
+        factors = self.random.normal(scale=0.1,
+                                     size=(len(labels), self.factors))
+        if warm_start and old_factors is not None:
+            for i, label in enumerate(labels):
+                if label in old_index:
+                    factors[i] = old_factors[old_index[label]]
+        return factors
+
+    def solve(self, ratings, fixed, target):
+        '''
+        One half of an ALS sweep: with the factors in fixed held
+        constant, every row of target is the regularized least squares
+        fit to that row's ratings.
+        '''
+        identity = np.eye(self.factors)
+        for row in xrange(ratings.shape[0]):
+            start, end = ratings.indptr[row], ratings.indptr[row + 1]
+            if start == end:
+                continue
+            known = fixed[ratings.indices[start:end]]
+            a = (known.T.dot(known) +
+                 self.regularization * (end - start) * identity)
+            b = known.T.dot(ratings.data[start:end])
+            target[row] = np.linalg.solve(a, b)
+
+    def predict(self, user, item):
+        '''
+        Predicted rating of item by user.
+        '''
+        return float(self.mean +
+                     self.user_factors[self.user_index[user]].dot(
+                         self.item_factors[self.item_index[item]]))
+
+    def recommend(self, user, n=10):
+        '''
+        The n best (predicted rating, item) tuples for user among the
+        items they haven't rated, like the top of get_recommendations.
+        '''
+        row = self.user_index[user]
+        scores = self.item_factors.dot(self.user_factors[row]) + self.mean
+        start, end = self.rated.indptr[row], self.rated.indptr[row + 1]
+        scores[self.rated.indices[start:end]] = -np.inf
+
+        n = min(n, len(scores))
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+        return [(float(scores[i]), self.items[i]) for i in best.tolist()
+                if scores[i] > -np.inf]
+
+    def rmse(self, test):
+        '''
+        Root mean squared error of the predictions for a list of
+        (user, item, rating) tuples. Users or items the model hasn't
+        seen are skipped.
+        '''
+        test = [(self.user_index[user], self.item_index[item], rating)
+                for user, item, rating in test
+                if user in self.user_index and item in self.item_index]
+        if not test:
+            return 0.0
+        users, items, ratings = [np.array(column) for column in zip(*test)]
+        predicted = self.mean + (self.user_factors[users] *
+                                 self.item_factors[items]).sum(axis=1)
+        return float(np.sqrt(np.mean((predicted - ratings) ** 2)))
+
+
+def train_test_split(prefs, test_fraction=0.1, seed=None):
+    '''
+    Randomly holds out test_fraction of the ratings. Returns the
+    training ratings as a RatingMatrix and the held-out ones as a list
+    of (user, item, rating) tuples.
+    '''
+    if not isinstance(prefs, RatingMatrix):
+        prefs = RatingMatrix.from_prefs(prefs)
+    coo = prefs.csr.tocoo()
+    test = np.random.RandomState(seed).rand(coo.nnz) < test_fraction
+
+    users = label_array(prefs.users)
+    items = label_array(prefs.items)
+    train = RatingMatrix.from_triples(users[coo.row[~test]],
+                                      items[coo.col[~test]],
+                                      coo.data[~test])
+    held_out = zip(users[coo.row[test]].tolist(),
+                   items[coo.col[test]].tolist(),
+                   coo.data[test].tolist())
+    return train, held_out
+
+
+def item_based_rmse(train, item_match, test):
+    '''
+    RMSE of the item based predictions get_recommended_items makes
+    (the similarity weighted average of the user's ratings of the
+    neighbors) for a list of (user, item, rating) tuples.
+    item_match is a neighbors.NeighborIndex built from train. When none
+    of the user's items has a say, the global mean is predicted.
+    '''
+    test = [(train.user_index[user], train.item_index[item], rating)
+            for user, item, rating in test
+            if user in train.user_index and item in train.item_index]
+    if not test:
+        return 0.0
+    users, items, ratings = [np.array(column) for column in zip(*test)]
+
+    similarity = item_match.similarity_matrix(train.items)
+    scores = sparse.csr_matrix(train.csr * similarity)
+    total_similar = sparse.csr_matrix(train.binary * similarity)
+    scores = np.asarray(scores[users, items]).ravel()
+    total_similar = np.asarray(total_similar[users, items]).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        predicted = np.where(total_similar != 0, scores / total_similar,
+                             train.csr.data.mean())
+    return float(np.sqrt(np.mean((predicted - ratings) ** 2)))
+
+
+if __name__ == '__main__':
+    import recommendations
+    from neighbors import NeighborIndex
+
+    train, test = train_test_split(recommendations.load_movie_lens(
+                                   matrix=True), seed=0)
+    model = FactorModel(seed=0).fit(train)
+    print 'ALS RMSE: %f' % model.rmse(test)
+    print 'item based RMSE: %f' % item_based_rmse(
+            train, NeighborIndex.from_matrix(train), test)
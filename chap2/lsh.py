@@ -0,0 +1,125 @@
+import time
+
+import numpy as np
+
+from ratings import RatingMatrix
+
+
+class LSHIndex(object):
+    '''
+    Approximate nearest neighbor index over the users of a RatingMatrix,
+    using random-projection locality sensitive hashing. Every user's
+    ratings are mean-centered (which makes the angle between two users
+    follow their pearson correlation) and projected onto n_bits random
+    hyperplanes per table; the signs of the projections are the user's
+    bucket in that table. Users that share a bucket in any table are
+    candidate neighbors.
+
+    The knobs trade recall for latency: more tables find more of the
+    true neighbors but return more candidates to re-rank, more bits per
+    table make the buckets smaller, and probes=1 also looks in every
+    bucket one bit flip away.
+    '''
+    def __init__(self, prefs, n_tables=8, n_bits=12, probes=0, seed=None):
+        if not isinstance(prefs, RatingMatrix):
+            prefs = RatingMatrix.from_prefs(prefs)
+        self.users = prefs.users
+        self.user_index = prefs.user_index
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.probes = probes
+
+        # subtract every user's mean rating from their own ratings
+        ratings = prefs.csr.copy()
+        counts = np.diff(ratings.indptr)
+        means = np.asarray(ratings.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        ratings.data -= np.repeat(means, counts)
+
+        random = np.random.RandomState(seed)
+        planes = random.randn(ratings.shape[1], n_tables * n_bits)
+        bits = (ratings * planes) > 0
+
+        powers = 1 << np.arange(n_bits, dtype=np.int64)
+        self.codes = (bits.reshape(-1, n_tables, n_bits) * powers).sum(axis=2)
+
+        # bucket code -> array of user ids, for every table
+        self.tables = []
+        for t in xrange(n_tables):
+            order = np.argsort(self.codes[:, t], kind='mergesort')
+            codes, starts = np.unique(self.codes[order, t], return_index=True)
+            members = np.split(order, starts[1:])
+            self.tables.append(dict(zip(codes.tolist(), members)))
+
+    def candidates(self, person):
+        '''
+        Returns the users that share a bucket with person in any table
+        (or a bucket one bit away, if probes is set).
+        '''
+        row = self.user_index[person]
+        found = []
+        for t in xrange(self.n_tables):
+            code = int(self.codes[row, t])
+            keys = [code]
+            if self.probes:
+                keys.extend([code ^ (1 << b) for b in xrange(self.n_bits)])
+            for key in keys:
+                if key in self.tables[t]:
+                    found.append(self.tables[t][key])
+
+        if not found:
+            return []
+        ids = np.unique(np.concatenate(found))
+        return [self.users[i] for i in ids.tolist() if i != row]
+
+
+def benchmark(prefs, top_matches, similarity_fn, people=100, n=10,
+              settings=((4, 8, 0), (8, 8, 0), (8, 12, 0), (8, 12, 1),
+                        (16, 12, 1)), seed=0):
+    '''
+    Compares top_matches with and without an index on a sample of
+    people. For every (n_tables, n_bits, probes) setting it prints the
+    index build time, the recall of the exact top n, the average number
+    of candidates and the average query time, next to the exact path.
+    '''
+    if not isinstance(prefs, RatingMatrix):
+        prefs = RatingMatrix.from_prefs(prefs)
+    random = np.random.RandomState(seed)
+    sample = [prefs.users[i] for i in random.choice(
+              len(prefs.users), min(people, len(prefs.users)), replace=False)]
+
+    # only the top_matches calls are timed, on both paths
+    start = time.time()
+    found = [top_matches(prefs, person, n, similarity_fn)
+             for person in sample]
+    exact_time = (time.time() - start) / len(sample)
+    exact = dict((person, set(other for _, other in matches))
+                 for person, matches in zip(sample, found))
+    print 'exact: %.2f ms/query' % (exact_time * 1000)
+
+    for n_tables, n_bits, probes in settings:
+        start = time.time()
+        index = LSHIndex(prefs, n_tables, n_bits, probes, seed)
+        build_time = time.time() - start
+
+        start = time.time()
+        found = [top_matches(prefs, person, n, similarity_fn, index=index)
+                 for person in sample]
+        query_time = (time.time() - start) / len(sample)
+
+        hits = 0
+        candidates = 0
+        for person, matches in zip(sample, found):
+            hits += len(exact[person] & set(other for _, other in matches))
+            candidates += len(index.candidates(person))
+
+        print ('tables=%d bits=%d probes=%d: build %.2f s, recall %.3f, '
+               '%d candidates, %.2f ms/query' %
+               (n_tables, n_bits, probes, build_time,
+                float(hits) / (len(sample) * n),
+                candidates / len(sample), query_time * 1000))
+
+
+if __name__ == '__main__':
+    import recommendations
+    benchmark(recommendations.load_movie_lens(matrix=True),
+              recommendations.top_matches, recommendations.sim_pearson)
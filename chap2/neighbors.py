@@ -0,0 +1,550 @@
+import ctypes
+import heapq
+import multiprocessing
+import os
+
+import numpy as np
+from scipy import sparse
+
+from ratings import RatingMatrix, label_array, pair_stats, \
+        score_from_stats, scores_from_stats
+
+# rating arrays shared with the worker processes of build_item_neighbors
+_shared = {}
+
+
+def save_array(file_name, array):
+    '''
+    np.save to a temporary file next to file_name, then renamed over it.
+    Writing in place would truncate a file other arrays may be mapped
+    from, and touching those afterwards kills the process with SIGBUS.
+    '''
+    temporary = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(temporary, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.rename(temporary, file_name)
+
+
+class NeighborIndex(object):
+    '''
+    Fixed-width table of the most similar items of every item: row i of
+    self.neighbors holds the ids (positions in self.labels) of item i's
+    neighbors, best first, and the same row of self.scores holds their
+    similarity scores. Short rows are padded with id -1.
+
+    The table can be saved to a directory and memory-mapped back, so a
+    process can start serving get_recommended_items straight away and
+    several processes share one copy of it through the page cache.
+    It behaves like the itemMatch dict returned by
+    calculate_similar_items, ie. index['Superman Returns'] returns
+    [(score, item), ...].
+    '''
+    def __init__(self, labels, neighbors, scores):
+        self.labels = list(labels)
+        self.label_index = dict((label, i)
+                                for i, label in enumerate(self.labels))
+        self.neighbors = neighbors
+        self.scores = scores
+
+    @classmethod
+    def from_matrix(cls, matrix, n=10, metric='euclidean', block_size=256,
+                    workers=1, progress=None):
+        '''
+        Builds the index for a RatingMatrix with build_item_neighbors.
+        '''
+        neighbors, scores = build_item_neighbors(matrix, n, metric,
+                                                 block_size, workers,
+                                                 progress)
+        return cls(matrix.items, neighbors, scores)
+
+    @classmethod
+    def from_item_match(cls, item_match):
+        '''
+        Converts an itemMatch dict, as returned by calculate_similar_items,
+        into an index.
+        '''
+        labels = list(item_match)
+        label_index = dict((label, i) for i, label in enumerate(labels))
+        width = max([len(matches) for matches in item_match.values()] or [0])
+
+        neighbors = np.empty((len(labels), width), dtype=np.int32)
+        neighbors.fill(-1)
+        scores = np.zeros((len(labels), width), dtype=np.float64)
+        for i, label in enumerate(labels):
+            for j, (score, other) in enumerate(item_match[label]):
+                neighbors[i, j] = label_index[other]
+                scores[i, j] = score
+        return cls(labels, neighbors, scores)
+
+    def save(self, path):
+        '''
+        Writes the index to the directory path as three .npy arrays:
+        the neighbors, the scores and the item labels (so labels keep
+        their type, eg. ints stay ints).
+        Every file is written under a temporary name and renamed over
+        the old one, so processes that have the old index memory-mapped
+        keep reading the old files instead of crashing.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # labels of a single plain type get a typed array, anything else
+        # (mixed types, tuples, ...) is pickled in an object array
+        types = set(type(label) for label in self.labels)
+        if len(types) == 1 and types <= set([str, unicode, int, long, float]):
+            labels = np.array(self.labels)
+        else:
+            labels = label_array(self.labels)
+        save_array(os.path.join(path, 'labels.npy'), labels)
+        save_array(os.path.join(path, 'neighbors.npy'), self.neighbors)
+        save_array(os.path.join(path, 'scores.npy'), self.scores)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Loads an index written by save. The arrays are memory-mapped,
+        so only the rows that are actually used get read from disk.
+        '''
+        labels = np.load(os.path.join(path, 'labels.npy'),
+                         allow_pickle=True).tolist()
+        neighbors = np.load(os.path.join(path, 'neighbors.npy'),
+                            mmap_mode=mmap_mode)
+        scores = np.load(os.path.join(path, 'scores.npy'),
+                         mmap_mode=mmap_mode)
+        return cls(labels, neighbors, scores)
+
+    # dict-like access, so the index can stand in for itemMatch
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __contains__(self, item):
+        return item in self.label_index
+
+    def __getitem__(self, item):
+        row = self.label_index[item]
+        return [(score, self.labels[j]) for j, score in
+                zip(self.neighbors[row].tolist(), self.scores[row].tolist())
+                if j >= 0]
+
+    def keys(self):
+        return list(self.labels)
+
+    def similarity_matrix(self, labels):
+        '''
+        The index as a sparse (items x items) matrix, with rows and
+        columns in the order of labels. Items not in labels are dropped.
+        '''
+        label_index = dict((label, i) for i, label in enumerate(labels))
+        positions = np.array([label_index.get(label, -1)
+                              for label in self.labels] + [-1])
+
+        rows = np.repeat(positions[:-1], self.neighbors.shape[1])
+        cols = positions[np.asarray(self.neighbors).ravel()]
+        scores = np.asarray(self.scores).ravel()
+
+        # padding (-1) maps to the last, -1, position as well
+        keep = (rows >= 0) & (cols >= 0)
+        return sparse.csr_matrix((scores[keep], (rows[keep], cols[keep])),
+                                 shape=(len(labels), len(labels)))
+
+    def recommend(self, user_ratings):
+        '''
+        get_recommended_items for an index: gathers the neighbor rows of
+        every item in user_ratings (a dict of item: rating) and adds up
+        the similarity weighted ratings with np.bincount.
+        '''
+        rated = [(self.label_index[item], rating)
+                 for item, rating in user_ratings.items()
+                 if item in self.label_index]
+        if not rated:
+            return []
+        rows = np.array([row for row, _ in rated])
+        ratings = np.array([rating for _, rating in rated], dtype=np.float64)
+
+        neighbors = np.asarray(self.neighbors[rows])
+        similarities = np.asarray(self.scores[rows])
+        weighted = similarities * ratings[:, None]
+
+        # skip padding and items the user already rated
+        keep = (neighbors >= 0) & ~np.in1d(neighbors, rows).reshape(
+                neighbors.shape)
+        neighbors = neighbors[keep]
+        scores = np.bincount(neighbors, weights=weighted[keep],
+                             minlength=len(self.labels))
+        total_similar = np.bincount(neighbors, weights=similarities[keep],
+                                    minlength=len(self.labels))
+
+        rankings = [(scores[i] / total_similar[i], self.labels[i])
+                    for i in np.flatnonzero(total_similar != 0).tolist()]
+
+        rankings.sort()
+        rankings.reverse()
+        return rankings
+
+
+def build_item_neighbors(matrix, n=10, metric='euclidean', block_size=256,
+                         workers=1, progress=None):
+    '''
+    Computes the n most similar items for every item of a RatingMatrix.
+    The item-item similarities are built block_size rows at a time from
+    sparse matrix products, so memory stays bounded by
+    block_size x number of items no matter how large the catalog is.
+
+    With workers > 1 the blocks are shared out to a pool of processes,
+    which all read the same copy of the ratings from shared memory.
+    progress, if given, is called as progress(done, total) every time
+    a block of items is finished.
+
+    Returns two fixed-width (items x n) arrays: neighbor item ids and
+    their similarity scores, best first.
+    '''
+    item_count = len(matrix.items)
+    n = max(min(n, item_count - 1), 0)
+
+    neighbors = np.zeros((item_count, n), dtype=np.int32)
+    scores = np.zeros((item_count, n), dtype=np.float64)
+
+    arrays = rating_arrays(matrix)
+    shards = [(start, min(start + block_size, item_count), n, metric)
+              for start in xrange(0, item_count, block_size)]
+
+    pool = None
+    if workers > 1 and len(shards) > 1:
+        shared = dict((name, share_array(array))
+                      for name, array in arrays.items())
+        pool = multiprocessing.Pool(workers, init_worker, (shared,))
+        results = pool.imap_unordered(worker_shard, shards)
+    else:
+        results = (shard_top_n(arrays, *shard) for shard in shards)
+
+    try:
+        done = 0
+        for start, end, shard_neighbors, shard_scores in results:
+            neighbors[start:end] = shard_neighbors
+            scores[start:end] = shard_scores
+            done += end - start
+            if progress:
+                progress(done, item_count)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return neighbors, scores
+
+
+def rating_arrays(matrix):
+    '''
+    The flat arrays build_item_neighbors needs from a RatingMatrix: the
+    ratings by item (CSC) and by user (CSR), plus the shape.
+    '''
+    return {'item_data': matrix.csc.data,
+            'item_indices': matrix.csc.indices,
+            'item_indptr': matrix.csc.indptr,
+            'user_data': matrix.csr.data,
+            'user_indices': matrix.csr.indices,
+            'user_indptr': matrix.csr.indptr,
+            'user_binary': matrix.binary.data,
+            'user_squared': matrix.squared.data,
+            'label_rank': label_rank(matrix.items),
+            'shape': np.array(matrix.csr.shape)}
+
+
+def label_rank(labels):
+    '''
+    Position of every label in sorted(labels), used to break ties
+    between equal scores the way sorting (score, label) tuples does.
+    '''
+    order = sorted(xrange(len(labels)), key=labels.__getitem__)
+    rank = np.empty(len(labels), dtype=np.int64)
+    rank[order] = np.arange(len(labels))
+    return rank
+
+
+def share_array(array):
+    '''
+    Copies array into a block of shared memory, which forked worker
+    processes can read without a copy of their own.
+    '''
+    raw = multiprocessing.RawArray(ctypes.c_char, max(array.nbytes, 1))
+    np.frombuffer(raw, dtype=array.dtype)[:array.size] = array.ravel()
+    return raw, array.dtype, array.shape
+
+
+def init_worker(shared):
+    for name, (raw, dtype, shape) in shared.items():
+        size = int(np.prod(shape))
+        _shared[name] = np.frombuffer(raw, dtype=dtype)[:size].reshape(shape)
+
+
+def worker_shard(shard):
+    return shard_top_n(_shared, *shard)
+
+
+def shard_top_n(arrays, start, end, n, metric):
+    '''
+    Top n neighbors for the items start:end.
+    '''
+    user_count, item_count = arrays['shape']
+    items = sparse.csr_matrix((arrays['item_data'], arrays['item_indices'],
+                               arrays['item_indptr']),
+                              shape=(item_count, user_count), copy=False)
+    users = [sparse.csr_matrix((arrays[name], arrays['user_indices'],
+                                arrays['user_indptr']),
+                               shape=(user_count, item_count), copy=False)
+             for name in ('user_data', 'user_binary', 'user_squared')]
+
+    block = items[start:end]
+    stats = pair_stats(block, binary(block), squared(block), *users)
+    block_neighbors, block_scores = block_top_n(
+            scores_from_stats(metric, *stats), start, n,
+            arrays['label_rank'])
+    return start, end, block_neighbors, block_scores
+
+
+def binary(matrix):
+    '''
+    Same sparsity pattern as matrix, with every stored value set to 1.
+    '''
+    return sparse.csr_matrix((np.ones_like(matrix.data), matrix.indices,
+                              matrix.indptr), shape=matrix.shape, copy=False)
+
+
+def squared(matrix):
+    return sparse.csr_matrix((matrix.data ** 2, matrix.indices,
+                              matrix.indptr), shape=matrix.shape, copy=False)
+
+
+def block_top_n(block, start, n, rank=None):
+    '''
+    Picks the n best scores of every row of a block of similarities,
+    where row i of the block is item start + i (which is skipped, since
+    an item is not its own neighbor).
+    '''
+    rows = np.arange(block.shape[0])
+    block[rows, start + rows] = -np.inf
+    return rows_top_n(block, n, rank)
+
+
+def rows_top_n(block, n, rank=None):
+    '''
+    Column ids and scores of the n best scores of every row of block,
+    best first. Equal scores are ordered by rank (see label_rank),
+    highest first, so the result is the top of what sorting
+    (score, label) tuples with reverse=True gives, like top_matches
+    and get_recommended_items do. Without rank, ties go by column.
+    '''
+    rows = np.arange(block.shape[0])
+    if rank is None:
+        rank = np.arange(block.shape[1])
+
+    if n == 0:
+        return np.zeros((len(rows), 0)), np.zeros((len(rows), 0))
+
+    # argpartition only keeps the n best columns of every row,
+    # so only those need to be sorted.
+    top = np.argpartition(-block, n - 1, axis=1)[:, :n]
+    top_scores = block[rows[:, None], top]
+
+    # argpartition picks any of the columns tied with the n-th best
+    # score; where there are more of those than places left, take the
+    # ones with the highest rank instead
+    threshold = top_scores.min(axis=1)
+    above = (block > threshold[:, None]).sum(axis=1)
+    tied = (block == threshold[:, None]).sum(axis=1)
+    for row in np.flatnonzero(above + tied > n).tolist():
+        candidates = np.flatnonzero(block[row] == threshold[row])
+        candidates = candidates[np.argsort(-rank[candidates],
+                                           kind='mergesort')]
+        top[row] = np.concatenate([
+                np.flatnonzero(block[row] > threshold[row]),
+                candidates[:n - above[row]]])
+        top_scores[row] = block[row, top[row]]
+
+    # lexsort sorts by its last key first: score, then rank
+    order = np.lexsort((-rank[top], -top_scores), axis=1)
+    return top[rows[:, None], order], top_scores[rows[:, None], order]
+
+
+class IncrementalItemSimilarity(object):
+    '''
+    Item neighbor lists that can be kept up to date one rating at a time.
+    For every pair of items rated by the same user it keeps running
+    sufficient statistics (co-count, the two sums, the two sums of squares
+    and the sum of products), which is all euclidean, pearson and cosine
+    need. A new rating from a user only touches the pairs between the
+    rated item and the user's other items, so add_rating costs
+    O(affected pairs) instead of a full calculate_similar_items. The
+    exception is a neighbor that gets less similar: an item outside the
+    list may overtake it, so all the pairs of that item are rescanned.
+
+    Neighbors are ordered like calculate_similar_items orders them, equal
+    scores by label, but only items that share a rater with the item are
+    listed; calculate_similar_items fills the rest of the n places with
+    unrelated items scoring 0, which add nothing to recommendations.
+
+    self.prefs and self.item_match can be passed straight to
+    get_recommended_items.
+    '''
+    def __init__(self, n=10, metric='euclidean'):
+        self.n = n
+        self.metric = metric
+        self.prefs = {}
+        self.item_match = {}
+        # item -> {other item: stats}. Both directions share one stats
+        # list, ordered by item_ids: [count, sum of the lower id's ratings,
+        # sum of the higher id's ratings, sum of squares of the lower,
+        # sum of squares of the higher, sum of products]
+        self.pairs = {}
+        self.item_ids = {}
+
+    @classmethod
+    def from_prefs(cls, prefs, n=10, metric='euclidean'):
+        '''
+        Builds the statistics for existing ratings (a prefs dict or a
+        RatingMatrix) with sparse matrix products instead of replaying
+        every rating through add_rating.
+        '''
+        if not isinstance(prefs, RatingMatrix):
+            prefs = RatingMatrix.from_prefs(prefs)
+        model = cls(n, metric)
+        model.prefs = prefs.to_prefs()
+        model.item_ids = dict((item, i) for i, item in enumerate(prefs.items))
+        for item in prefs.items:
+            model.pairs[item] = {}
+            model.item_match[item] = []
+
+        items = prefs.csc.T.tocsr()
+        items_binary = binary(items)
+        items_squared = squared(items)
+        counts = (items_binary * items_binary.T).tocoo()
+        upper = counts.row < counts.col
+        lo, hi = counts.row[upper], counts.col[upper]
+
+        sums = (items * items_binary.T).tocsr()
+        squares = (items_squared * items_binary.T).tocsr()
+        products = (items * items.T).tocsr()
+
+        def pick(matrix, rows, cols):
+            return np.asarray(matrix[rows, cols]).ravel()
+
+        stats = [counts.data[upper], pick(sums, lo, hi), pick(sums, hi, lo),
+                 pick(squares, lo, hi), pick(squares, hi, lo),
+                 pick(products, lo, hi)]
+        scores = scores_from_stats(metric, *stats)
+
+        labels = prefs.items
+        for k, pair in enumerate(zip(*[column.tolist() for column in stats])):
+            pair = list(pair)
+            model.pairs[labels[lo[k]]][labels[hi[k]]] = pair
+            model.pairs[labels[hi[k]]][labels[lo[k]]] = pair
+
+        # every pair is a candidate neighbor in both directions; sort them
+        # by item, then by descending score and label (like rows_top_n)
+        # and keep the first n
+        rows = np.concatenate([lo, hi])
+        cols = np.concatenate([hi, lo])
+        both = np.concatenate([scores, scores])
+        rank = label_rank(prefs.items)
+        order = np.lexsort((-rank[cols], -both, rows))
+        rows, cols, both = rows[order], cols[order], both[order]
+        starts = np.searchsorted(rows, np.arange(len(labels)))
+        ends = np.searchsorted(rows, np.arange(len(labels)), side='right')
+        for i, label in enumerate(labels):
+            end = min(ends[i], starts[i] + n)
+            model.item_match[label] = [
+                    (score, labels[j]) for score, j in
+                    zip(both[starts[i]:end].tolist(),
+                        cols[starts[i]:end].tolist())]
+        return model
+
+    def add_rating(self, user, item, rating):
+        '''
+        Records (or replaces) user's rating of item, then updates the
+        statistics of every pair it touches and the neighbor lists of
+        the items involved.
+        '''
+        if item not in self.item_ids:
+            self.item_ids[item] = len(self.item_ids)
+            self.pairs[item] = {}
+            self.item_match[item] = []
+
+        user_ratings = self.prefs.setdefault(user, {})
+        old_rating = user_ratings.get(item)
+        others = [(other, other_rating)
+                  for other, other_rating in user_ratings.items()
+                  if other != item]
+
+        for other, other_rating in others:
+            if other not in self.pairs[item]:
+                pair = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+                self.pairs[item][other] = pair
+                self.pairs[other][item] = pair
+            pair = self.pairs[item][other]
+            if old_rating is not None:
+                self.update_pair(pair, item, other, old_rating,
+                                 other_rating, -1)
+            self.update_pair(pair, item, other, rating, other_rating, 1)
+
+        user_ratings[item] = rating
+
+        self.patch(item, [other for other, _ in others])
+        for other, _ in others:
+            self.patch(other, [item])
+
+    def update_pair(self, pair, item, other, rating, other_rating, sign):
+        if self.item_ids[item] > self.item_ids[other]:
+            rating, other_rating = other_rating, rating
+        pair[0] += sign
+        pair[1] += sign * rating
+        pair[2] += sign * other_rating
+        pair[3] += sign * rating ** 2
+        pair[4] += sign * other_rating ** 2
+        pair[5] += sign * rating * other_rating
+
+    def score(self, item, other):
+        '''
+        Similarity of item and other from their pair statistics.
+        '''
+        count, sum1, sum2, sum1_sq, sum2_sq, product_sum = \
+                self.pairs[item][other]
+        if self.item_ids[item] > self.item_ids[other]:
+            sum1, sum2, sum1_sq, sum2_sq = sum2, sum1, sum2_sq, sum1_sq
+        return score_from_stats(self.metric, float(count), sum1, sum2,
+                                sum1_sq, sum2_sq, product_sum)
+
+    def rescore(self, item):
+        '''
+        Rebuilds the neighbor list of item from all of its pairs.
+        '''
+        self.item_match[item] = heapq.nlargest(
+                self.n, [(self.score(item, other), other)
+                         for other in self.pairs[item]])
+
+    def patch(self, item, changed):
+        '''
+        Updates the neighbor list of item after its pairs with the items
+        in changed did, in O(len(changed) + n). Only if one of them was a
+        neighbor and got less similar can an item outside the list
+        overtake it, which needs a full rescore.
+        '''
+        old_scores = dict((match, score)
+                          for score, match in self.item_match[item])
+        new = [(self.score(item, other), other) for other in changed]
+        outside = len(self.pairs[item]) - len(
+                set(old_scores).union(changed))
+        if outside and any(other in old_scores and
+                           score < old_scores[other]
+                           for score, other in new):
+            self.rescore(item)
+            return
+
+        changed = set(changed)
+        matches = [match for match in self.item_match[item]
+                   if match[1] not in changed]
+        matches.extend(new)
+        matches.sort(reverse=True)
+        self.item_match[item] = matches[:self.n]
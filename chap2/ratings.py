@@ -0,0 +1,326 @@
+import numpy as np
+from scipy import sparse
+
+
+class RatingMatrix(object):
+    '''
+    Compact store of user -> item ratings. User and item ids are interned
+    to ints (their position in self.users and self.items) and the ratings
+    are kept both in a CSR matrix (one row per user) and in a CSC matrix
+    (one column per item), so rows and columns are cheap to slice.
+
+    It also behaves like a read-only version of the dict-of-dicts prefs
+    used in recommendations.py, ie. matrix['Toby'] returns
+    {'Snakes on a Plane': 4.5, ...}, so existing code keeps working.
+    '''
+    def __init__(self, users, items, ratings):
+        self.users = list(users)
+        self.items = list(items)
+        self.user_index = dict((user, i) for i, user in enumerate(self.users))
+        self.item_index = dict((item, i) for i, item in enumerate(self.items))
+
+        self.csr = sparse.csr_matrix(ratings, dtype=np.float64)
+        self.csr.sum_duplicates()
+        self.csr.sort_indices()
+        self.csc = self.csr.tocsc()
+        self.csc.sort_indices()
+
+        # binary and squared versions of the ratings are needed by the
+        # vectorized similarity functions, so build them lazily once.
+        self._binary = None
+        self._squared = None
+        self._transposed = None
+
+    @classmethod
+    def from_triples(cls, users, items, ratings):
+        '''
+        Builds a RatingMatrix from three parallel sequences of user ids,
+        item ids and ratings. If a user rated the same item more than once,
+        the last rating wins (just like assigning into the prefs dict).
+        '''
+        user_labels, user_ids = intern_labels(users)
+        item_labels, item_ids = intern_labels(items)
+        ratings = np.asarray(ratings, dtype=np.float64)
+
+        # keep only the last occurrence of every (user, item) pair
+        keys = user_ids.astype(np.int64) * len(item_labels) + item_ids
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+
+        coo = sparse.coo_matrix(
+                (ratings[last], (user_ids[last], item_ids[last])),
+                shape=(len(user_labels), len(item_labels)))
+        return cls(user_labels, item_labels, coo)
+
+    @classmethod
+    def from_prefs(cls, prefs):
+        '''
+        Builds a RatingMatrix from the nested dict prefs used throughout
+        recommendations.py, ie. {'User': {'item': 3.5}}.
+        '''
+        users = []
+        items = []
+        ratings = []
+        for user in prefs:
+            for item, rating in prefs[user].items():
+                users.append(user)
+                items.append(item)
+                ratings.append(rating)
+        return cls.from_triples(users, items, ratings)
+
+    def to_prefs(self):
+        '''
+        Turns the matrix back into a nested dict of preferences.
+        '''
+        return dict((user, self[user]) for user in self.users)
+
+    def transpose(self):
+        '''
+        Swaps users and items, the matrix equivalent of transform_prefs.
+        '''
+        return RatingMatrix(self.items, self.users, self.csc.T)
+
+    # dict-like access, so the matrix can stand in for prefs
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, user):
+        return user in self.user_index
+
+    def __getitem__(self, user):
+        indices, values = self.user_row(user)
+        return dict((self.items[i], v)
+                for i, v in zip(indices.tolist(), values.tolist()))
+
+    def keys(self):
+        return list(self.users)
+
+    # array access
+
+    def user_row(self, user):
+        '''
+        Returns the item ids and ratings (as two sorted arrays) of user.
+        '''
+        row = self.user_index[user]
+        start, end = self.csr.indptr[row], self.csr.indptr[row + 1]
+        return self.csr.indices[start:end], self.csr.data[start:end]
+
+    def co_ratings(self, user1, user2):
+        '''
+        Returns two aligned arrays with the ratings user1 and user2 gave
+        to the items they both rated.
+        '''
+        indices1, values1 = self.user_row(user1)
+        indices2, values2 = self.user_row(user2)
+        _, idx1, idx2 = np.intersect1d(indices1, indices2,
+                                       assume_unique=True,
+                                       return_indices=True)
+        return values1[idx1], values2[idx2]
+
+    @property
+    def binary(self):
+        if self._binary is None:
+            self._binary = self.csr.copy()
+            self._binary.data[:] = 1.0
+        return self._binary
+
+    @property
+    def squared(self):
+        if self._squared is None:
+            self._squared = self.csr.copy()
+            self._squared.data **= 2
+        return self._squared
+
+    def transposed(self):
+        '''
+        Returns the ratings, binary and squared matrices transposed to
+        items x users CSR, ready to be the right hand side of pair_stats.
+        '''
+        if self._transposed is None:
+            self._transposed = (self.csc.T.tocsr(),
+                                self.binary.T.tocsr(),
+                                self.squared.T.tocsr())
+        return self._transposed
+
+    def similarity(self, user1, user2, metric='pearson'):
+        '''
+        Similarity of two users computed over the items both rated.
+        '''
+        v1, v2 = self.co_ratings(user1, user2)
+        return float(scores_from_stats(metric, len(v1), v1.sum(), v2.sum(),
+                                       (v1 ** 2).sum(), (v2 ** 2).sum(),
+                                       (v1 * v2).sum()))
+
+    def similarities(self, user, metric='pearson', others=None):
+        '''
+        Similarity of user to every user in the matrix (including itself),
+        or only to the users at the positions others, computed in one go
+        with a handful of sparse matrix-vector products.
+        '''
+        indices, values = self.user_row(user)
+        ratings = np.zeros(len(self.items))
+        ratings[indices] = values
+        rated = np.zeros(len(self.items))
+        rated[indices] = 1
+
+        if others is None:
+            rows, rows_binary, rows_squared = (self.csr, self.binary,
+                                               self.squared)
+        else:
+            rows = self.csr[np.asarray(others, dtype=np.int64)]
+            rows_binary = sparse.csr_matrix(
+                    (np.ones_like(rows.data), rows.indices, rows.indptr),
+                    shape=rows.shape)
+            rows_squared = sparse.csr_matrix(
+                    (rows.data ** 2, rows.indices, rows.indptr),
+                    shape=rows.shape)
+
+        return scores_from_stats(metric, rows_binary.dot(rated),
+                                 rows_binary.dot(ratings), rows.dot(rated),
+                                 rows_binary.dot(ratings ** 2),
+                                 rows_squared.dot(rated), rows.dot(ratings))
+
+    def block_similarities(self, start, end, metric='pearson'):
+        '''
+        Dense (end - start) x len(users) array of similarities between
+        the users in rows start:end and every user in the matrix.
+        '''
+        stats = pair_stats(self.csr[start:end], self.binary[start:end],
+                           self.squared[start:end], *self.transposed())
+        return scores_from_stats(metric, *stats)
+
+
+def intern_labels(labels):
+    '''
+    Returns the distinct labels, sorted, and an array with the position
+    of every label among them. Labels keep their types: np.unique turns
+    a mix of ints and strings into strings and can't take tuples, so it
+    is only used on arrays that already have a plain dtype.
+    '''
+    if isinstance(labels, np.ndarray) and labels.dtype != object:
+        distinct, positions = np.unique(labels, return_inverse=True)
+        return distinct.tolist(), positions
+    labels = list(labels)
+    distinct = sorted(set(labels))
+    index = dict((label, i) for i, label in enumerate(distinct))
+    return distinct, np.array([index[label] for label in labels],
+                              dtype=np.int64)
+
+
+def label_array(labels):
+    '''
+    Returns labels as a one dimensional object array, which np.array
+    would make two dimensional when the labels are tuples.
+    '''
+    array = np.empty(len(labels), dtype=object)
+    for i, label in enumerate(labels):
+        array[i] = label
+    return array
+
+
+def pair_stats(block, block_binary, block_squared, full_t, full_binary_t,
+               full_squared_t):
+    '''
+    Computes, for every pair of rows (a, b) with a in block and b in the
+    full matrix, the sufficient statistics over their co-rated columns:
+    co-count, sum of a, sum of b, sum of a^2, sum of b^2 and sum of a * b.
+    The full matrix is passed already transposed (see
+    RatingMatrix.transposed). Every statistic is a single sparse matrix
+    product, returned as a dense array.
+    '''
+    n = (block_binary * full_binary_t).toarray()
+    sum1 = (block * full_binary_t).toarray()
+    sum2 = (block_binary * full_t).toarray()
+    sum1_sq = (block_squared * full_binary_t).toarray()
+    sum2_sq = (block_binary * full_squared_t).toarray()
+    product_sum = (block * full_t).toarray()
+
+    return n, sum1, sum2, sum1_sq, sum2_sq, product_sum
+
+
+def scores_from_stats(metric, n, sum1, sum2, sum1_sq, sum2_sq, product_sum):
+    '''
+    Turns the co-rating statistics returned by pair_stats into
+    similarity scores. Pairs with nothing in common, or with a zero
+    variance for pearson, score 0.
+    '''
+    n = np.asarray(n, dtype=np.float64)
+    shared = n > 0
+    safe_n = np.where(shared, n, 1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'euclidean':
+            sum_of_squares = np.maximum(sum1_sq + sum2_sq - 2 * product_sum,
+                                        0.0)
+            scores = 1 / (1 + sum_of_squares)
+        elif metric == 'pearson':
+            numerator = product_sum - (sum1 * sum2 / safe_n)
+            denominator = (np.maximum(sum1_sq - sum1 ** 2 / safe_n, 0.0) *
+                           np.maximum(sum2_sq - sum2 ** 2 / safe_n, 0.0)) ** 0.5
+            shared = shared & (denominator > 1e-9)
+            scores = numerator / denominator
+        elif metric == 'cosine':
+            denominator = (sum1_sq * sum2_sq) ** 0.5
+            shared = shared & (denominator > 0)
+            scores = product_sum / denominator
+        else:
+            raise ValueError('Unknown similarity metric: %s' % metric)
+
+    return np.where(shared, scores, 0.0)
+
+
+def score_from_stats(metric, n, sum1, sum2, sum1_sq, sum2_sq, product_sum):
+    '''
+    Plain float version of scores_from_stats for a single pair, which
+    avoids the numpy overhead when scoring pairs one at a time.
+    '''
+    if n <= 0:
+        return 0.0
+
+    if metric == 'euclidean':
+        return 1 / (1 + max(sum1_sq + sum2_sq - 2 * product_sum, 0.0))
+    elif metric == 'pearson':
+        numerator = product_sum - (sum1 * sum2 / n)
+        denominator = (max(sum1_sq - sum1 ** 2 / n, 0.0) *
+                       max(sum2_sq - sum2 ** 2 / n, 0.0)) ** 0.5
+        if denominator <= 1e-9:
+            return 0.0
+        return numerator / denominator
+    elif metric == 'cosine':
+        denominator = (sum1_sq * sum2_sq) ** 0.5
+        if denominator <= 0:
+            return 0.0
+        return product_sum / denominator
+    else:
+        raise ValueError('Unknown similarity metric: %s' % metric)
+
+
+def top_n(scores, labels, n, exclude=None):
+    '''
+    Returns the n highest (score, label) tuples in descending order,
+    skipping the position exclude. Ties are ordered like
+    sorted(..., reverse=True) would order them.
+    '''
+    if n <= 0:
+        return []
+    scores = np.array(scores, dtype=np.float64)
+    if exclude is not None:
+        scores[exclude] = -np.inf
+    count = len(scores) - (exclude is not None)
+    if n >= count:
+        candidates = np.arange(len(scores))
+    else:
+        # anything scoring at least the n-th best score is a candidate,
+        # which keeps ties so the final ordering matches a full sort.
+        threshold = np.partition(scores, len(scores) - n)[len(scores) - n]
+        candidates = np.flatnonzero(scores >= threshold)
+    if exclude is not None:
+        candidates = candidates[candidates != exclude]
+
+    result = [(float(scores[i]), labels[i]) for i in candidates.tolist()]
+    result.sort(reverse=True)
+    return result[:n]
@@ -1,19 +1,11 @@
+import numpy as np
 from scipy import stats as sp
-from requests import get
+from ratings import RatingMatrix, label_array, top_n
+from neighbors import build_item_neighbors, label_rank, NeighborIndex, \
+        rows_top_n
 import os.path
 import zipfile
 
-# download and extract MovieLens dataset if it's not present
-if not os.path.exists('ml-100k/u.item') or not os.path.exists('ml-100k/u.data'):
-    zip_download = get('http://files.grouplens.org/datasets/movielens/ml-100k.zip')
-    with open('ml-100k.zip', 'wb') as f:
-        f.write(zip_download.content)
-
-    with zipfile.ZipFile('ml-100k.zip', 'r') as zip_file:
-        zip_file.extract('ml-100k/u.data')
-        zip_file.extract('ml-100k/u.item')
-
-
 critics = {'Lisa Rose':
             {'Lady in the Water': 2.5, 'Snakes on a Plane': 3.5,
                 'Just My Luck': 3.0, 'Superman Returns': 3.5,
@@ -52,6 +44,9 @@ def sim_distance(prefs, person1, person2):
     Calculates euclidean distance between two people
     by comparing their shared item scores.
     '''
+    if isinstance(prefs, RatingMatrix):
+        return prefs.similarity(person1, person2, 'euclidean')
+
     shared_items = shared_items_fn(prefs, person1, person2)
 
     if len(shared_items) == 0:
@@ -70,6 +65,9 @@ def sim_pearson(prefs, person1, person2):
     Calculates the pearson r for two people
     using the shared item scores.
     '''
+    if isinstance(prefs, RatingMatrix):
+        return prefs.similarity(person1, person2, 'pearson')
+
     shared_items = shared_items_fn(prefs, person1, person2)
 
     n = len(shared_items)
@@ -101,6 +99,12 @@ def scipy_sim_pearson(prefs, person1, person2):
     scipy.stats.pearsonr function for improved
     performance.
     '''
+    if isinstance(prefs, RatingMatrix):
+        v1, v2 = prefs.co_ratings(person1, person2)
+        if len(v1) == 0:
+            return 0
+        return sp.pearsonr(v1, v2)[0]
+
     shared_items = {item: 1 for item in prefs[person1]
             if item in prefs[person2]}
 
@@ -111,10 +115,66 @@ def scipy_sim_pearson(prefs, person1, person2):
             [prefs[person2][item] for item in shared_items])[0]
 
 
-def top_matches(prefs, person, n=5, similarity_fn=scipy_sim_pearson):
+# cosine similarity
+def sim_cosine(prefs, person1, person2):
+    '''
+    Calculates the cosine of the angle between two people's
+    shared item scores.
+    '''
+    if isinstance(prefs, RatingMatrix):
+        return prefs.similarity(person1, person2, 'cosine')
+
+    shared_items = shared_items_fn(prefs, person1, person2)
+
+    if len(shared_items) == 0:
+        return 0
+
+    product_sum = sum([prefs[person1][item] * prefs[person2][item]
+                   for item in shared_items])
+    sum1_sq = sum([prefs[person1][item] ** 2 for item in shared_items])
+    sum2_sq = sum([prefs[person2][item] ** 2 for item in shared_items])
+
+    if sum1_sq == 0 or sum2_sq == 0:
+        return 0
+
+    return product_sum / (sum1_sq * sum2_sq) ** 0.5
+
+
+# similarity functions that RatingMatrix can compute for every other
+# person at once
+SIMILARITY_METRICS = {sim_distance: 'euclidean',
+                      sim_pearson: 'pearson',
+                      scipy_sim_pearson: 'pearson',
+                      sim_cosine: 'cosine'}
+
+
+def top_matches(prefs, person, n=5, similarity_fn=scipy_sim_pearson,
+                index=None):
     '''
     Calculates n top similar matches for person.
+    If an approximate nearest neighbor index (lsh.LSHIndex) is given,
+    only the candidates it returns are scored.
     '''
+    known_metric = (isinstance(prefs, RatingMatrix) and
+                    similarity_fn in SIMILARITY_METRICS)
+
+    if index is not None:
+        candidates = index.candidates(person)
+        if known_metric:
+            scores = prefs.similarities(
+                    person, SIMILARITY_METRICS[similarity_fn],
+                    [prefs.user_index[other] for other in candidates])
+            return top_n(scores, candidates, n)
+        scores = [(similarity_fn(prefs, person, other), other)
+                  for other in candidates]
+        scores.sort()
+        scores.reverse()
+        return scores[:n]
+
+    if known_metric:
+        scores = prefs.similarities(person, SIMILARITY_METRICS[similarity_fn])
+        return top_n(scores, prefs.users, n, exclude=prefs.user_index[person])
+
     scores = [(similarity_fn(prefs, person, other), other)
                 for other in prefs if other != person]
     scores.sort()
@@ -126,6 +186,10 @@ def get_recommendations(prefs, person, similarity_fn=scipy_sim_pearson):
     '''
     Generates an orderded list of similar items for person.
     '''
+    if isinstance(prefs, RatingMatrix) and similarity_fn in SIMILARITY_METRICS:
+        return _matrix_recommendations(prefs, person,
+                                       SIMILARITY_METRICS[similarity_fn])
+
     totals = {}
     similarity_sums = {}
 
@@ -152,6 +216,32 @@ def get_recommendations(prefs, person, similarity_fn=scipy_sim_pearson):
     return rankings
 
 
+def _matrix_recommendations(matrix, person, metric):
+    '''
+    get_recommendations for a RatingMatrix: the similarity weighted
+    totals for every item are two sparse matrix-vector products.
+    '''
+    row = matrix.user_index[person]
+    similarities = matrix.similarities(person, metric)
+    # only people with a positive similarity get a say
+    similarities[row] = 0
+    similarities[similarities < 0] = 0
+
+    totals = matrix.csc.T.dot(similarities)
+    similarity_sums = matrix.binary.T.dot(similarities)
+
+    # skip items the person already rated (with anything other than 0)
+    indices, values = matrix.user_row(person)
+    similarity_sums[indices[values != 0]] = 0
+
+    rankings = [(totals[i] / similarity_sums[i], matrix.items[i])
+            for i in np.flatnonzero(similarity_sums > 0).tolist()]
+
+    rankings.sort()
+    rankings.reverse()
+    return rankings
+
+
 def transform_prefs(prefs):
     '''
     Transforms user based preferences into item based
@@ -160,6 +250,9 @@ def transform_prefs(prefs):
     {'User': 5.0}. Useful when trying to get similar items
     instead of similar users.
     '''
+    if isinstance(prefs, RatingMatrix):
+        return prefs.transpose()
+
     results = {}
     for person in prefs:
         for item in prefs[person]:
@@ -169,11 +262,35 @@ def transform_prefs(prefs):
     return results
 
 
-def calculate_similar_items(prefs, n=10):
+def print_progress(done, total):
+    '''
+    Progress callback for calculate_similar_items that prints
+    how many items are done so far.
+    '''
+    print "%d / %d" % (done, total)
+
+
+def calculate_similar_items(prefs, n=10, similarity_fn=sim_distance,
+                            block_size=256, workers=1, progress=None):
     '''
     Generates a list of items along with n
     top matched similar items and their similarity score.
+    The similarity functions known to RatingMatrix (euclidean, pearson
+    and cosine) are computed for all item pairs at once, block_size
+    items at a time, spread over workers processes.
+    progress, if given, is called as progress(done, total), eg.
+    progress=print_progress.
     '''
+    if similarity_fn in SIMILARITY_METRICS:
+        if not isinstance(prefs, RatingMatrix):
+            prefs = RatingMatrix.from_prefs(prefs)
+        neighbors, scores = build_item_neighbors(
+                prefs, n, SIMILARITY_METRICS[similarity_fn], block_size,
+                workers, progress)
+        items = prefs.items
+        return dict((items[i], [(score, items[j]) for j, score in
+                    zip(neighbors[i].tolist(), scores[i].tolist())])
+                    for i in xrange(len(items)))
 
     result = {}
 
@@ -181,12 +298,10 @@ def calculate_similar_items(prefs, n=10):
     c = 0
     for item in item_prefs:
         c += 1
-        if c % 100 == 0:
-            print "%d / %d" % (c, len(item_prefs))
+        if progress and c % 100 == 0:
+            progress(c, len(item_prefs))
 
-        scores = top_matches(item_prefs, item, n, sim_distance)
-        # use sim_distance, because pearsonr will
-        # have problems with divide by 0 and introduce nan's
+        scores = top_matches(item_prefs, item, n, similarity_fn)
         result[item] = scores
     return result
 
@@ -197,7 +312,12 @@ def get_recommended_items(prefs, itemMatch, user):
     Generates a list of recommended items for a user
     based on user preferences (prefs[user]) as well 
     as a list of similar items.
+    itemMatch can also be a NeighborIndex, eg. one saved earlier and
+    loaded with NeighborIndex.load.
     '''
+    if isinstance(itemMatch, NeighborIndex):
+        return itemMatch.recommend(prefs[user])
+
     user_ratings = prefs[user]
     scores = {}
     total_similar = {}
@@ -219,24 +339,162 @@ def get_recommended_items(prefs, itemMatch, user):
     return rankings
 
 
+def recommend_all(prefs, n=10, itemMatch=None, block_size=1024):
+    '''
+    Item based recommendations for every user at once. Yields
+    (user, rankings) tuples, where rankings are the top n of what
+    get_recommended_items would return for that user.
+    Scores for block_size users at a time come from one sparse product
+    of their ratings with the item similarity matrix, so memory stays
+    bounded by block_size x number of items.
+    itemMatch can be a dict from calculate_similar_items or a
+    NeighborIndex; if it's missing it gets built with the defaults.
+    '''
+    if not isinstance(prefs, RatingMatrix):
+        prefs = RatingMatrix.from_prefs(prefs)
+    if itemMatch is None:
+        itemMatch = NeighborIndex.from_matrix(prefs)
+    elif not isinstance(itemMatch, NeighborIndex):
+        itemMatch = NeighborIndex.from_item_match(itemMatch)
+
+    similarity = itemMatch.similarity_matrix(prefs.items)
+    items = label_array(prefs.items)
+    top = min(n, len(prefs.items))
+    rank = label_rank(prefs.items)
+
+    for start in xrange(0, len(prefs.users), block_size):
+        end = min(start + block_size, len(prefs.users))
+        ratings = prefs.csr[start:end]
+        rated = prefs.binary[start:end]
+
+        scores = (ratings * similarity).toarray()
+        total_similar = (rated * similarity).toarray()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rankings = np.where(total_similar != 0,
+                                scores / total_similar, -np.inf)
+        # skip items the user already rated
+        rankings[rated.nonzero()] = -np.inf
+
+        # equal scores are ordered by item label, like sorting the
+        # (score, item) tuples in get_recommended_items does
+        best, best_scores = rows_top_n(rankings, top, rank)
+
+        for i in xrange(end - start):
+            found = best_scores[i] > -np.inf
+            yield (prefs.users[start + i],
+                   zip(best_scores[i][found].tolist(),
+                       items[best[i][found]].tolist()))
+
+
 # MovieLens dataset related functions
-def load_movie_lens(path='ml-100k/'):
+def download_movie_lens(path='ml-100k/'):
     '''
-    Simple function to read in the MovieLens data
-    required to play around with all the other functions.
+    Downloads and extracts the MovieLens dataset into path
+    if it's not present.
+    '''
+    if os.path.exists(path + 'u.item') and os.path.exists(path + 'u.data'):
+        return
+
+    # only needed for the download, so don't make every import pay for it
+    from requests import get
+
+    zip_download = get('http://files.grouplens.org/datasets/movielens/ml-100k.zip')
+    with open('ml-100k.zip', 'wb') as f:
+        f.write(zip_download.content)
+
+    target = os.path.dirname(os.path.dirname(path)) or '.'
+    with zipfile.ZipFile('ml-100k.zip', 'r') as zip_file:
+        zip_file.extract('ml-100k/u.data', target)
+        zip_file.extract('ml-100k/u.item', target)
+
+
+def read_ratings_file(file_name, chunk_size=1 << 24):
+    '''
+    Parses a MovieLens u.data file (user, movie id, rating and timestamp
+    separated by whitespace) with numpy, chunk_size bytes at a time.
+    Returns a (ratings x 4) int64 array.
+    '''
+    chunks = []
+    tail = ''
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            # only parse whole lines, keep the rest for the next chunk
+            end = chunk.rfind('\n') + 1
+            tail = chunk[end:]
+            chunks.append(np.fromstring(chunk[:end], dtype=np.int64, sep=' '))
+    if tail.strip():
+        chunks.append(np.fromstring(tail, dtype=np.int64, sep=' '))
+
+    return np.concatenate(chunks or [np.zeros(0, dtype=np.int64)]).reshape(-1, 4)
+
+
+def file_stamp(file_names):
     '''
+    Modification times and sizes of file_names, used to tell whether
+    a cache built from them is stale.
+    '''
+    stamp = []
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        stamp.extend([stat.st_mtime, stat.st_size])
+    return np.array(stamp, dtype=np.float64)
+
+
+def load_movie_lens_arrays(path='ml-100k/'):
+    '''
+    Returns the MovieLens ratings as three arrays: user ids (as strings),
+    movie titles and ratings. The parsed arrays are cached in
+    path + 'ratings.npz', keyed on the modification time and size of
+    u.data and u.item, so later calls only read the cache. The cache is
+    written to a temporary file and renamed into place, and one that
+    can't be read is built again.
+    '''
+    download_movie_lens(path)
+    sources = [path + 'u.data', path + 'u.item']
+    cache_file = path + 'ratings.npz'
+    stamp = file_stamp(sources)
+
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                if np.array_equal(cache['stamp'], stamp):
+                    return cache['users'], cache['titles'], cache['ratings']
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+            pass
+
     movies = {}
     with open(path + 'u.item') as u_items:
         for line in u_items:
             (id, title) = line.split('|')[0:2]
-            movies[id] = title
+            movies[int(id)] = title
+
+    titles_by_id = np.array([movies.get(i, '') for i in
+                             xrange(max(movies) + 1)])
+    data = read_ratings_file(path + 'u.data')
+    users = data[:, 0].astype(str)
+    titles = titles_by_id[data[:, 1]]
+    ratings = data[:, 2].astype(np.float64)
 
-    prefs = {}
+    temporary = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(temporary, 'wb') as f:
+        np.savez(f, stamp=stamp, users=users, titles=titles, ratings=ratings)
+    os.rename(temporary, cache_file)
+    return users, titles, ratings
 
-    with open(path + 'u.data') as u_data:
-        for line in u_data:
-            (user, movie_id, rating, time) = line.split('\t')
-            prefs.setdefault(user, {})
-            prefs[user][movies[movie_id]] = float(rating)
 
-    return prefs
+def load_movie_lens(path='ml-100k/', matrix=False):
+    '''
+    Simple function to read in the MovieLens data
+    required to play around with all the other functions.
+    With matrix=True the ratings are returned as a RatingMatrix
+    instead of a nested dict.
+    '''
+    ratings = RatingMatrix.from_triples(*load_movie_lens_arrays(path))
+    if matrix:
+        return ratings
+    return ratings.to_prefs()
@@ -1,28 +1,234 @@
 from PIL import Image, ImageDraw
-import random
+from collections import namedtuple
+import multiprocessing
+import numpy as np
+import os
 
 def read_file(file_name):
     '''
     Read a tab delimited file of frequent words on blogs.
     Row 1 are words, Column 1 are blog names.
+    Sparse .mtx files (see read_sparse) are read into the same lists.
     '''
-    with open(file_name, 'rb') as f:
-        lines = f.readlines()
-
-    col_names = lines[0].strip().split('\t')[1:]
+    if file_name.endswith('.mtx'):
+        row_names, col_names, data = read_sparse(file_name)
+        return (row_names, col_names, data.toarray().tolist())
 
     row_names = []
     data = []
 
-    for line in lines[1:]:
-        row = line.strip().split('\t')
-        # append blog name
-        row_names.append(row[0])
-        data.append([float(i) for i in row[1:]])
+    with open(file_name, 'rb') as f:
+        col_names = f.readline().strip().split('\t')[1:]
+
+        for line in f:
+            row = line.strip().split('\t')
+            # append blog name
+            row_names.append(row[0])
+            data.append([float(i) for i in row[1:]])
 
     return (row_names, col_names, data)
 
 
+def read_sparse(file_name):
+    '''
+    Reads the sparse format generatefeedvector writes for large feed
+    lists: a Matrix Market coordinate file holding only the nonzero word
+    counts, with the blog names in file_name + '.rows' and the words in
+    file_name + '.cols', one per line.
+    Returns (row_names, col_names, data), data being a float32 CSR matrix.
+    '''
+    from scipy import sparse as sp
+
+    with open(file_name, 'rb') as f:
+        header = f.readline()
+        if not header.startswith('%%MatrixMarket matrix coordinate'):
+            raise ValueError('%s is not a Matrix Market coordinate file' %
+                             file_name)
+        line = f.readline()
+        while line.startswith('%'):
+            line = f.readline()
+        rows, columns, entries = [int(i) for i in line.split()]
+        # every entry is a line of "row column count", 1-based
+        values = np.fromstring(f.read(), dtype=np.float64,
+                               sep=' ').reshape(entries, 3)
+
+    data = sp.coo_matrix((values[:, 2].astype(np.float32),
+                          (values[:, 0].astype(np.int64) - 1,
+                           values[:, 1].astype(np.int64) - 1)),
+                         shape=(rows, columns)).tocsr()
+    return (read_names(file_name + '.rows'), read_names(file_name + '.cols'),
+            data)
+
+
+def read_names(file_name):
+    with open(file_name, 'rb') as f:
+        return [line.rstrip('\r\n') for line in f]
+
+
+def read_columns(file_name):
+    '''
+    Reads only the first row (the words) of a blogdata-format file.
+    '''
+    with open(file_name, 'rb') as f:
+        return f.readline().strip().split('\t')[1:]
+
+
+def iter_file(file_name, chunk_rows=1000):
+    '''
+    Streams a blogdata-format file chunk_rows rows at a time, so files
+    of any size can be processed in constant memory. Yields
+    (row_names, data) tuples, where data is a (rows x columns) float
+    array parsed with numpy.
+    '''
+    with open(file_name, 'rb') as f:
+        columns = len(f.readline().strip().split('\t')) - 1
+        row_names = []
+        values = []
+        for line in f:
+            name, _, rest = line.rstrip('\r\n').partition('\t')
+            row_names.append(name)
+            values.append(rest)
+            if len(row_names) == chunk_rows:
+                yield row_names, parse_rows(values, columns)
+                row_names = []
+                values = []
+        if row_names:
+            yield row_names, parse_rows(values, columns)
+
+
+def parse_rows(values, columns):
+    '''
+    Parses a list of tab separated lines of numbers into a 2d array.
+    '''
+    return np.fromstring('\t'.join(values), dtype=np.float64,
+                         sep='\t').reshape(len(values), columns)
+
+
+def load_matrix(file_name, sparse=False, cache=True, chunk_rows=1000):
+    '''
+    Faster read_file: parses a blogdata-format file straight into a
+    float32 numpy array, or a scipy CSR matrix with sparse=True, since
+    word counts are mostly zero. Returns (row_names, col_names, data).
+    Sparse .mtx files (see read_sparse) are loaded as well.
+
+    With cache=True the parsed matrix is also written to a sidecar
+    directory next to the file (file_name + '.cache'), keyed on the
+    file's modification time and size. Later loads memory-map the
+    arrays from there instead of parsing the text again.
+    '''
+    cache_dir = file_name + '.cache'
+    kind = 'sparse' if sparse else 'dense'
+    stat = os.stat(file_name)
+    stamp = np.array([stat.st_mtime, stat.st_size])
+
+    if cache:
+        cached = load_matrix_cache(cache_dir, kind, stamp)
+        if cached:
+            return cached
+
+    if file_name.endswith('.mtx'):
+        row_names, col_names, data = read_sparse(file_name)
+        if not sparse:
+            data = data.toarray()
+    else:
+        row_names, col_names, data = parse_file(file_name, sparse,
+                                                chunk_rows)
+
+    if cache:
+        save_matrix_cache(cache_dir, kind, stamp, row_names, col_names, data)
+    return row_names, col_names, data
+
+
+def parse_file(file_name, sparse=False, chunk_rows=1000):
+    '''
+    Parses a blogdata-format file chunk by chunk into a float32 array
+    or CSR matrix. Returns (row_names, col_names, data).
+    '''
+    if sparse:
+        # scipy is only needed for sparse output
+        from scipy import sparse as sp
+
+    col_names = read_columns(file_name)
+    row_names = []
+    chunks = []
+    for names, chunk in iter_file(file_name, chunk_rows):
+        row_names.extend(names)
+        chunk = chunk.astype(np.float32)
+        if sparse:
+            chunk = sp.csr_matrix(chunk)
+        chunks.append(chunk)
+
+    if sparse:
+        if chunks:
+            data = sp.vstack(chunks, format='csr')
+        else:
+            data = sp.csr_matrix((0, len(col_names)), dtype=np.float32)
+    else:
+        if chunks:
+            data = np.vstack(chunks)
+        else:
+            data = np.zeros((0, len(col_names)), dtype=np.float32)
+    return row_names, col_names, data
+
+
+def save_matrix_cache(cache_dir, kind, stamp, row_names, col_names, data):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    if kind == 'sparse':
+        arrays = {'data': data.data, 'indices': data.indices,
+                  'indptr': data.indptr}
+    else:
+        arrays = {'data': data}
+    # every file is written under a temporary name and renamed into
+    # place: arrays returned by earlier loads are memory-mapped from the
+    # old files, and truncating those would crash them with SIGBUS
+    for name, array in arrays.items():
+        replace_file(os.path.join(cache_dir, '%s-%s.npy' % (kind, name)),
+                     np.save, array)
+    # the stamp is written last, so a half written cache is never used
+    replace_file(os.path.join(cache_dir, '%s-meta.npz' % kind), np.savez,
+                 stamp=stamp, shape=np.array(data.shape),
+                 row_names=np.array(row_names),
+                 col_names=np.array(col_names))
+
+
+def replace_file(file_name, save, *args, **kwargs):
+    '''
+    Calls save (np.save or np.savez) on a temporary file next to
+    file_name, then renames it over file_name.
+    '''
+    temporary = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(temporary, 'wb') as f:
+        save(f, *args, **kwargs)
+    os.rename(temporary, file_name)
+
+
+def load_matrix_cache(cache_dir, kind, stamp):
+    '''
+    Returns (row_names, col_names, data) from a load_matrix sidecar, or
+    None if it's missing or was built from an older version of the file.
+    '''
+    meta_file = os.path.join(cache_dir, '%s-meta.npz' % kind)
+    if not os.path.exists(meta_file):
+        return None
+    meta = np.load(meta_file)
+    if not np.array_equal(meta['stamp'], stamp):
+        return None
+
+    def array(name):
+        return np.load(os.path.join(cache_dir, '%s-%s.npy' % (kind, name)),
+                       mmap_mode='r')
+
+    if kind == 'sparse':
+        from scipy import sparse as sp
+        data = sp.csr_matrix((array('data'), array('indices'),
+                              array('indptr')),
+                             shape=tuple(meta['shape']), copy=False)
+    else:
+        data = array('data')
+    return meta['row_names'].tolist(), meta['col_names'].tolist(), data
+
+
 def pearson(v1, v2):
     '''
     Calculate the pearson r for two sets of values.
@@ -39,8 +245,8 @@ def pearson(v1, v2):
     product_sum = sum([v1[i] * v2[i] for i in xrange(len(v1))])
 
     numerator = product_sum - (sum1 * sum2 / len(v1))
-    denominator = ((sum1_square - sum1 ** 2 / len(v1)) ** 0.5
-                  * (sum2_square - sum2 ** 2 / len(v1)))
+    denominator = ((sum1_square - sum1 ** 2 / len(v1))
+                  * (sum2_square - sum2 ** 2 / len(v1))) ** 0.5
 
     if denominator == 0:
         return 0
@@ -48,6 +254,153 @@ def pearson(v1, v2):
     return 1.0 - (numerator / denominator)
 
 
+def tanimoto(v1, v2):
+    '''
+    Calculate the tanimoto coefficient distance for two sets of values,
+    treating every non-zero value as "present". Returns 1.0 minus the
+    share of items present in both sets out of the items present in
+    either one.
+    '''
+    count1, count2, shared = 0, 0, 0
+    for i in xrange(len(v1)):
+        if v1[i] != 0:
+            count1 += 1
+        if v2[i] != 0:
+            count2 += 1
+        if v1[i] != 0 and v2[i] != 0:
+            shared += 1
+
+    if count1 + count2 - shared == 0:
+        return 0
+
+    return 1.0 - (float(shared) / (count1 + count2 - shared))
+
+
+# vectorized distance kernels: each takes two 2d arrays a and b and returns
+# the (len(a) x len(b)) array of distances between their rows
+
+def pearson_distances(a, b):
+    '''
+    1.0 - pearson r for every pair of rows, like pearson().
+    '''
+    a = a - a.mean(axis=1)[:, None]
+    b = b - b.mean(axis=1)[:, None]
+    numerator = a.dot(b.T)
+    denominator = np.outer(np.sqrt((a ** 2).sum(axis=1)),
+                           np.sqrt((b ** 2).sum(axis=1)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, 0.0, 1.0 - numerator / denominator)
+
+
+def euclidean_distances(a, b):
+    '''
+    Euclidean distance for every pair of rows.
+    '''
+    squares = ((a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None, :]
+               - 2 * a.dot(b.T))
+    return np.sqrt(np.maximum(squares, 0.0))
+
+
+def cosine_distances(a, b):
+    '''
+    1.0 - the cosine of the angle between every pair of rows.
+    '''
+    denominator = np.outer(np.sqrt((a ** 2).sum(axis=1)),
+                           np.sqrt((b ** 2).sum(axis=1)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, 1.0, 1.0 - a.dot(b.T) / denominator)
+
+
+def tanimoto_distances(a, b):
+    '''
+    Tanimoto distance for every pair of rows, like tanimoto().
+    '''
+    a = (a != 0).astype(np.float64)
+    b = (b != 0).astype(np.float64)
+    shared = a.dot(b.T)
+    either = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - shared
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(either == 0, 0.0, 1.0 - shared / either)
+
+
+DISTANCE_KERNELS = {'pearson': pearson_distances,
+                    'euclidean': euclidean_distances,
+                    'cosine': cosine_distances,
+                    'tanimoto': tanimoto_distances,
+                    pearson: pearson_distances,
+                    tanimoto: tanimoto_distances}
+
+
+def distance_kernel(distance):
+    '''
+    Returns the vectorized kernel for distance, which is either the name
+    of a kernel in DISTANCE_KERNELS or a function of two vectors. Other
+    functions get wrapped so they're called pair by pair.
+    '''
+    if distance in DISTANCE_KERNELS:
+        return DISTANCE_KERNELS[distance]
+
+    def kernel(a, b):
+        return np.array([[distance(list(v1), list(v2)) for v2 in b]
+                         for v1 in a]).reshape(len(a), len(b))
+    return kernel
+
+
+def condensed_index(n, i, j):
+    '''
+    Position of the pair (i, j), i < j, in a condensed distance array of
+    n rows, which stores the upper triangle of the distance matrix row
+    by row (the same layout scipy.spatial.distance.pdist uses).
+    '''
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def condensed_pair(n, index):
+    '''
+    The (i, j) pair stored at index in a condensed distance array.
+    '''
+    i = int(n - 2 - np.floor(np.sqrt(-8 * index + 4 * n * (n - 1) - 7) / 2.0
+                             - 0.5))
+    j = int(index + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2)
+    return i, j
+
+
+def condensed_row(n, i, others=None):
+    '''
+    Positions in a condensed distance array of the pairs between row i and
+    the rows in others (all other rows by default).
+    '''
+    if others is None:
+        others = np.arange(n)
+        others = others[others != i]
+    low = np.minimum(i, others)
+    high = np.maximum(i, others)
+    return condensed_index(n, low, high)
+
+
+def pairwise_distances(rows, distance=pearson, block_size=256):
+    '''
+    Computes the distance between every pair of rows and returns them as a
+    condensed float array (see condensed_index). The rows are processed
+    block_size at a time through the vectorized kernel for distance.
+    '''
+    vectors = np.asarray(rows, dtype=np.float64)
+    kernel = distance_kernel(distance)
+    n = len(vectors)
+
+    distances = np.zeros(n * (n - 1) // 2)
+    for start in xrange(0, n, block_size):
+        end = min(start + block_size, n)
+        block = kernel(vectors[start:end], vectors[start:])
+        for i in xrange(start, end):
+            first = condensed_index(n, i, i + 1)
+            distances[first:first + n - i - 1] = block[i - start, i - start + 1:]
+    return distances
+
+
 class Bicluster(object):
     def __init__(self, vector, left=None, right=None, distance=0.0, id=None):
         self.left = left
@@ -62,192 +415,588 @@ def hcluster(rows, distance=pearson):
     Uses rows of data to create a tree of nodes, which represent
     clustered data.
     '''
-    distances = {}
+    kernel = distance_kernel(distance)
+    vectors = np.array(rows, dtype=np.float64)
+    n = len(rows)
+
+    # all the pairwise distances in one go, as a condensed array
+    distances = pairwise_distances(vectors, distance)
     current_clust_id = -1
 
-    # create a list of Bicluster nodes representing every row
-    clust = [Bicluster(rows[i], id=i) for i in xrange(len(rows))]
-
-    while len(clust) > 1:
-        lowest_pair = (0, 1)
-        closest = distance(clust[0].vector, clust[1].vector)
-
-        # compare every pair to every other pair
-        for i in xrange(len(clust)):
-            for j in xrange(i + 1, len(clust)):
-                # check if distance is in distances and if not - 
-                # calculate it and add it.
-                if (clust[i].id, clust[j].id) not in distances:
-                    distances[(clust[i].id, clust[j].id)] = distance(
-                            clust[i].vector, clust[j].vector)
-
-                d = distances[(clust[i].id, clust[j].id)]
-
-                if d < closest:
-                    closest = d
-                    lowest_pair = (i, j)
-
-        # calculate average of the lower_pair of clusters ie.
-        # add the lowest pair rows column by column and divide by 2.0
-        # each time.
-        merged_vectors = [
-            (clust[lowest_pair[0]].vector[i] + clust[lowest_pair[1]].vector[i]) / 2.0
-            for i in xrange(len(clust[0].vector))]
-
-        # use averaged pair of clusters and treat it as the parent node
-        # of the lowest pair of nodes:
-        # Create new parent cluster and attach the lowest_pair to its
-        # left and right branches and assign the current_clust_id so
-        # that these parent-nodes have negative ids whereas the end-leaf nodes
-        # have positive id.
-        new_cluster = Bicluster(merged_vectors, left=clust[lowest_pair[0]],
-                                right=clust[lowest_pair[1]],
-                                distance=closest, id=current_clust_id)
-
-        # update the current_clust_id
+    # create a list of Bicluster nodes representing every row. Every
+    # position (slot) in this list holds one cluster that's still waiting
+    # to be merged.
+    clust = [Bicluster(rows[i], id=i) for i in xrange(n)]
+    active = np.ones(n, dtype=bool)
+
+    for step in xrange(n - 1):
+        # find the closest pair of clusters that are still active
+        lowest = np.argmin(distances)
+        closest = distances[lowest]
+        i, j = condensed_pair(n, lowest)
+
+        # calculate average of the lowest pair of clusters and treat it as
+        # the parent node of the lowest pair of nodes. Parent nodes have
+        # negative ids whereas the end-leaf nodes have positive ids.
+        merged_vector = (vectors[i] + vectors[j]) / 2.0
+        new_cluster = Bicluster(merged_vector.tolist(), left=clust[i],
+                                right=clust[j], distance=closest,
+                                id=current_clust_id)
         current_clust_id -= 1
-        # delete the lowest_pair from the clust list, since they've
-        # been successfully processed
-        del clust[lowest_pair[1]]
-        del clust[lowest_pair[0]]
 
-        # add parent-node cluster to cluster list to be processed
-        clust.append(new_cluster)
+        # the new cluster takes over slot i, slot j is retired by making
+        # all of its distances infinite
+        clust[i] = new_cluster
+        clust[j] = None
+        vectors[i] = merged_vector
+        active[j] = False
+        distances[condensed_row(n, j)] = np.inf
+
+        # distances from the new cluster to every other active cluster
+        others = np.flatnonzero(active)
+        others = others[others != i]
+        if len(others):
+            distances[condensed_row(n, i, others)] = kernel(
+                    merged_vector[None, :], vectors[others])[0]
 
     # return the root node
-    return clust[0]
+    return clust[int(np.flatnonzero(active)[0])]
 
 
-def kcluster(rows, distance=pearson, k=4):
-    # collects the min and max for a given row
-    ranges = [(min([row[i] for row in rows]), max([row[i] for row in rows]))
-            for i in xrange(len(rows[0]))]
+def distance_row(distances, n, i, active):
+    '''
+    Full length array of the distances from cluster slot i to every slot,
+    with infinity for i itself and for retired slots.
+    '''
+    others = np.arange(n)
+    others = others[others != i]
+    row = np.empty(n)
+    row[i] = np.inf
+    row[others] = distances[condensed_row(n, i, others)]
+    row[~active] = np.inf
+    return row
 
-    # creates k randomly placed centroids
-    clusters = [[random.random() * (ranges[i][1] - ranges[i][0]) + ranges[i][0]
-        for i in xrange(len(rows[0]))] for j in xrange(k)]
 
-    last_matches = None
+def lance_williams(linkage, d_ik, d_jk, size_i, size_j):
+    '''
+    Distance from the merge of clusters i and j to the clusters k, given
+    their distances to i and j and the cluster sizes.
+    '''
+    if linkage == 'single':
+        return np.minimum(d_ik, d_jk)
+    elif linkage == 'complete':
+        return np.maximum(d_ik, d_jk)
+    elif linkage == 'average':
+        return (size_i * d_ik + size_j * d_jk) / float(size_i + size_j)
+    raise ValueError('Unknown linkage: %s' % linkage)
 
-    for t in xrange(1000):
-        print 'Iteration %d' % t
-        best_matches = [[] for i in xrange(k)]
 
-        # iterate over each row
-        for j in xrange(len(rows)):
-            row = rows[j]
-            best_match = 0
-            # iterate over each cluster
-            for i in xrange(k):
-                d = distance(clusters[i], row)
-                # find the cluster closest to a row
-                if d < distance(clusters[best_match], row):
-                    best_match = i
-                # append the best matched row index to specific cluster 
-                # in list of clusters
-                best_matches[best_match].append(j)
-
-        if best_matches == last_matches:
+def hcluster_fast(rows, distance=pearson, linkage='centroid'):
+    '''
+    Same tree of Bicluster nodes as hcluster, in O(n^2) time instead of
+    rescanning every pair on each merge.
+
+    linkage picks how far apart two clusters are:
+    'single' (closest members), 'complete' (furthest members),
+    'average' (average over all member pairs) or 'centroid', which
+    averages the two merged vectors and measures from that, just like
+    hcluster does. The first three update distances with the
+    Lance-Williams formulas and find merges with the nearest-neighbor
+    chain algorithm. Centroid merges recompute the distances from the
+    new vector and keep every cluster's nearest neighbor cached.
+    '''
+    vectors = np.array(rows, dtype=np.float64)
+    n = len(rows)
+    distances = pairwise_distances(vectors, distance)
+
+    clust = [Bicluster(rows[i], id=i) for i in xrange(n)]
+    sizes = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    state = {'id': -1}
+
+    def merge(i, j, closest, merged_vector):
+        # the merged cluster takes over slot i and slot j is retired
+        clust[i] = Bicluster(merged_vector.tolist(), left=clust[i],
+                             right=clust[j], distance=closest,
+                             id=state['id'])
+        clust[j] = None
+        state['id'] -= 1
+        vectors[i] = merged_vector
+        sizes[i] += sizes[j]
+        active[j] = False
+        distances[condensed_row(n, j)] = np.inf
+
+    if linkage == 'centroid':
+        kernel = distance_kernel(distance)
+
+        # every slot's nearest neighbor and the distance to it
+        nearest = np.zeros(n, dtype=np.int64)
+        nearest_distance = np.empty(n)
+        nearest_distance.fill(np.inf)
+        for i in xrange(n):
+            row = distance_row(distances, n, i, active)
+            if n > 1:
+                nearest[i] = np.argmin(row)
+                nearest_distance[i] = row[nearest[i]]
+
+        for step in xrange(n - 1):
+            i = int(np.argmin(nearest_distance))
+            j = int(nearest[i])
+            if j < i:
+                i, j = j, i
+            closest = nearest_distance[i]
+
+            merge(i, j, closest, (vectors[i] + vectors[j]) / 2.0)
+            nearest_distance[j] = np.inf
+
+            others = np.flatnonzero(active)
+            others = others[others != i]
+            if not len(others):
+                break
+            new_distances = kernel(vectors[i][None, :], vectors[others])[0]
+            distances[condensed_row(n, i, others)] = new_distances
+
+            row = distance_row(distances, n, i, active)
+            nearest[i] = np.argmin(row)
+            nearest_distance[i] = row[nearest[i]]
+
+            # slots whose nearest neighbor was merged need a rescan, the
+            # rest only need to check whether the new cluster is closer
+            stale = others[(nearest[others] == i) | (nearest[others] == j)]
+            for k in stale.tolist():
+                row = distance_row(distances, n, k, active)
+                nearest[k] = np.argmin(row)
+                nearest_distance[k] = row[nearest[k]]
+            fresh = (new_distances < nearest_distance[others]) & \
+                    (nearest[others] != i) & (nearest[others] != j)
+            nearest[others[fresh]] = i
+            nearest_distance[others[fresh]] = new_distances[fresh]
+
+        return clust[int(np.flatnonzero(active)[0])]
+
+    # nearest-neighbor chain: follow nearest neighbors from any cluster
+    # until two clusters are each other's nearest neighbor, then merge them
+    chain = []
+    for step in xrange(n - 1):
+        while True:
+            if not chain:
+                chain.append(int(np.flatnonzero(active)[0]))
+            a = chain[-1]
+            row = distance_row(distances, n, a, active)
+            b = int(np.argmin(row))
+            # on ties prefer the previous cluster in the chain
+            if len(chain) > 1 and row[chain[-2]] == row[b]:
+                b = chain[-2]
+            if len(chain) > 1 and b == chain[-2]:
+                break
+            chain.append(b)
+
+        chain.pop()
+        chain.pop()
+        closest = row[b]
+        i, j = min(a, b), max(a, b)
+
+        others = np.flatnonzero(active)
+        others = others[(others != i) & (others != j)]
+        d_ik = distances[condensed_row(n, i, others)]
+        d_jk = distances[condensed_row(n, j, others)]
+        new_distances = lance_williams(linkage, d_ik, d_jk, sizes[i], sizes[j])
+
+        merged_vector = ((sizes[i] * vectors[i] + sizes[j] * vectors[j]) /
+                         (sizes[i] + sizes[j]))
+        merge(i, j, closest, merged_vector)
+        distances[condensed_row(n, i, others)] = new_distances
+
+    return clust[int(np.flatnonzero(active)[0])]
+
+
+# result of kcluster: clusters is a list of k lists of row indices,
+# centroids a (k x columns) array, inertia the sum of the distances from
+# every row to its centroid, iterations how many assignment steps ran and
+# converged whether the assignments stopped changing before max_iter.
+KClusterResult = namedtuple('KClusterResult', ['clusters', 'centroids',
+                                               'inertia', 'iterations',
+                                               'converged'])
+
+# rows shared with the kcluster worker processes
+_kcluster_rows = {}
+
+
+def kcluster(rows, distance=pearson, k=4, n_init=1, max_iter=1000,
+             processes=1, seed=None, full_result=False):
+    '''
+    Groups rows into k clusters with k-means. Every iteration assigns
+    all the rows to their closest centroid with a single vectorized
+    distance kernel call and moves every centroid to the mean of its
+    rows, until the assignments stop changing.
+    The starting centroids are picked with k-means++. The whole thing
+    is restarted n_init times (over processes worker processes; the
+    distance then needs to be a kernel name or a module level function)
+    and the run with the lowest inertia is kept.
+    Returns the k lists of row indices, or with full_result=True the
+    whole KClusterResult of that run.
+    '''
+    vectors = np.asarray(rows, dtype=np.float64)
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, n_init)
+    jobs = [(distance, k, max_iter, run_seed) for run_seed in seeds.tolist()]
+
+    if processes > 1 and n_init > 1:
+        # forked workers inherit the rows instead of getting a pickled copy
+        _kcluster_rows['rows'] = vectors
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(kcluster_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+            _kcluster_rows.clear()
+    else:
+        results = [kmeans(vectors, *job) for job in jobs]
+
+    best = min(results, key=lambda result: result.inertia)
+    if full_result:
+        return best
+    return best.clusters
+
+
+def kcluster_worker(job):
+    return kmeans(_kcluster_rows['rows'], *job)
+
+
+def kmeans_plus_plus(vectors, kernel, k, random):
+    '''
+    Picks k rows as starting centroids: the first one at random, every
+    next one with a probability proportional to its squared distance
+    from the closest centroid picked so far.
+    '''
+    centroids = [vectors[random.randint(len(vectors))]]
+    closest = kernel(vectors, centroids[0][None, :])[:, 0]
+
+    for i in xrange(1, k):
+        weights = np.maximum(closest, 0) ** 2
+        if weights.sum() > 0:
+            pick = random.choice(len(vectors), p=weights / weights.sum())
+        else:
+            pick = random.randint(len(vectors))
+        centroids.append(vectors[pick])
+        closest = np.minimum(closest,
+                             kernel(vectors, vectors[pick][None, :])[:, 0])
+
+    return np.array(centroids)
+
+
+def kmeans(vectors, distance, k, max_iter, seed):
+    '''
+    A single k-means run, see kcluster.
+    '''
+    kernel = distance_kernel(distance)
+    random = np.random.RandomState(seed)
+    centroids = kmeans_plus_plus(vectors, kernel, k, random)
+
+    last_matches = None
+    converged = False
+    iterations = 0
+
+    for t in xrange(max_iter):
+        iterations += 1
+        # distances from every row to every centroid, then the closest one
+        distances = kernel(vectors, centroids)
+        best_matches = distances.argmin(axis=1)
+
+        if last_matches is not None and np.array_equal(best_matches,
+                                                       last_matches):
+            converged = True
             break
         last_matches = best_matches
 
-        # iterate through the clusters again
+        # move every centroid to the average of its rows. Centroids
+        # without any rows stay where they are.
         for i in xrange(k):
-            # create list with 0.0s the size of the no. of columns
-            avgs = [0.0] * len(rows[0])
-            if len(best_matches[i]) > 0:
-                # iterate through a k cluster
-                for row_id in best_matches[i]:
-                    # iterate through a row's using the id
-                    # in the cluster
-                    for m in xrange(len(rows[row_id])):
-                        # and accumulate column by column.
-                        # essentially, we're summing up the columns
-                        # of each cluster. 
-                        avgs[m] += rows[row_id][m]
-                # iterate through the avgs
-                for j in xrange(len(avgs)):
-                    # divide each average by the length
-                    # of each cluster
-                    avgs[j] /= len(best_matches[i])
-                # overwrite each centroid with the updated averages
-                clusters[i] = avgs
-    return best_matches
+            members = vectors[best_matches == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+
+    # out of iterations, the centroids moved after the last assignment
+    if not converged:
+        distances = kernel(vectors, centroids)
+    inertia = distances[np.arange(len(vectors)), best_matches].sum()
+    clusters = [np.flatnonzero(best_matches == i).tolist() for i in xrange(k)]
+    return KClusterResult(clusters, centroids, float(inertia), iterations,
+                          converged)
+
+
+def minibatch_kcluster(file_name, distance=pearson, k=4, batch_size=1000,
+                       max_epochs=10, tol=1e-4, seed=None):
+    '''
+    Mini-batch k-means over a blogdata-format file that doesn't have to
+    fit in memory. The file is streamed batch_size rows at a time (see
+    iter_file); every batch is assigned to the closest centroids and each
+    centroid moves towards the running mean of all the rows it has been
+    given so far. Passes over the file stop after max_epochs or once no
+    centroid moved more than tol during a pass.
+
+    Returns a KClusterResult without the per-row clusters (which would
+    need memory for every row; use assign_file to stream them), where
+    inertia is the sum of distances seen in the last pass and iterations
+    counts the batches processed.
+    '''
+    kernel = distance_kernel(distance)
+    random = np.random.RandomState(seed)
+    centroids = None
+    counts = np.zeros(k)
+    batches = 0
+    converged = False
+
+    for epoch in xrange(max_epochs):
+        inertia = 0.0
+        start_centroids = None if centroids is None else centroids.copy()
+
+        for row_names, batch in iter_file(file_name, batch_size):
+            if centroids is None:
+                # seed the centroids from the first batch
+                centroids = kmeans_plus_plus(batch, kernel, k, random)
+                start_centroids = centroids.copy()
+
+            batches += 1
+            distances = kernel(batch, centroids)
+            best_matches = distances.argmin(axis=1)
+            inertia += distances[np.arange(len(batch)),
+                                 best_matches].sum()
+
+            # moving every centroid by (sum - members * centroid) / count
+            # keeps it at the mean of every row it has been assigned
+            for i in xrange(k):
+                members = batch[best_matches == i]
+                if len(members):
+                    counts[i] += len(members)
+                    centroids[i] += ((members.sum(axis=0) -
+                                      len(members) * centroids[i]) /
+                                     counts[i])
+
+        if centroids is None:
+            break
+        if np.abs(centroids - start_centroids).max() <= tol:
+            converged = True
+            break
+
+    return KClusterResult(None, centroids, float(inertia), batches,
+                          converged)
+
+
+def assign_file(file_name, centroids, distance=pearson, batch_size=1000):
+    '''
+    Streams (row name, cluster index) for every row of a blogdata-format
+    file, using the centroids from minibatch_kcluster.
+    '''
+    kernel = distance_kernel(distance)
+    for row_names, batch in iter_file(file_name, batch_size):
+        best_matches = kernel(batch, centroids).argmin(axis=1)
+        for name, match in zip(row_names, best_matches.tolist()):
+            yield name, match
 
 
 def print_clust(clust, labels=None, n=0):
     '''
     Print a simple representation of the clustered data.
     '''
-    for i in xrange(n):
-        print ' ',
-    if clust.id < 0:
-        print '-'
-    else:
-        if not labels:
-            print clust.id
+    # walk the tree with an explicit stack instead of recursion, so deep
+    # trees don't hit the recursion limit
+    stack = [(clust, n)]
+    while stack:
+        clust, n = stack.pop()
+        for i in xrange(n):
+            print ' ',
+        if clust.id < 0:
+            print '-'
         else:
-            print labels[clust.id]
-
-    if clust.left:
-        print_clust(clust.left, labels=labels, n=n+1)
-    if clust.right:
-        print_clust(clust.right, labels=labels, n=n+1)
+            if not labels:
+                print clust.id
+            else:
+                print labels[clust.id]
 
+        # push right first, so the left branch gets printed first
+        if clust.right:
+            stack.append((clust.right, n + 1))
+        if clust.left:
+            stack.append((clust.left, n + 1))
 
-def get_height(clust):
-    if not clust.left and not clust.right:
-        return 1
 
-    # recursive yay!
-    return get_height(clust.left) + get_height(clust.right)
+# nodes is the tree in pre-order (every node before its children, left
+# branch first) and the other fields are lists aligned with it: heights
+# are leaf counts, depths the distance to the furthest leaf, offsets the
+# sum of the distances of all ancestors (how far right the node is drawn,
+# before scaling) and positions the vertical center of the node, in leaves.
+DendrogramLayout = namedtuple('DendrogramLayout', ['nodes', 'heights',
+                                                   'depths', 'offsets',
+                                                   'positions'])
 
 
-def get_depth(clust):
-    if not clust.left and not clust.right:
-        return 0
+def layout_dendrogram(clust):
+    '''
+    Computes everything needed to draw the tree in two passes over a
+    pre-order list of its nodes, without recursion: heights and depths
+    bottom up (walking the list backwards visits children before their
+    parents), then offsets and positions top down.
+    '''
+    nodes = []
+    stack = [clust]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        if node.right:
+            stack.append(node.right)
+        if node.left:
+            stack.append(node.left)
+
+    index = dict((id(node), i) for i, node in enumerate(nodes))
+    heights = [1] * len(nodes)
+    depths = [0.0] * len(nodes)
+    for i in xrange(len(nodes) - 1, -1, -1):
+        node = nodes[i]
+        if node.left or node.right:
+            left, right = index[id(node.left)], index[id(node.right)]
+            heights[i] = heights[left] + heights[right]
+            depths[i] = max(depths[left], depths[right]) + node.distance
+
+    offsets = [0.0] * len(nodes)
+    starts = [0] * len(nodes)
+    positions = [0.0] * len(nodes)
+    for i, node in enumerate(nodes):
+        positions[i] = starts[i] + heights[i] / 2.0
+        if node.left or node.right:
+            left, right = index[id(node.left)], index[id(node.right)]
+            starts[left] = starts[i]
+            starts[right] = starts[i] + heights[left]
+            offsets[left] = offsets[right] = offsets[i] + node.distance
+
+    return DendrogramLayout(nodes, heights, depths, offsets, positions)
 
-    return max(get_depth(clust.left), get_depth(clust.right)) + clust.distance
 
+def get_height(clust):
+    '''
+    Number of leaves under clust.
+    '''
+    height = 0
+    stack = [clust]
+    while stack:
+        node = stack.pop()
+        if not node.left and not node.right:
+            height += 1
+        else:
+            stack.append(node.left)
+            stack.append(node.right)
+    return height
 
-def draw_node(draw, clust, x, y, scaling, labels):
-    if clust.id < 0:
-        h1 = get_height(clust.left) * 20
-        h2 = get_height(clust.right) * 20
 
-        top = y - (h1 + h2) / 2
-        bottom = y + (h1 + h2) / 2
+def get_depth(clust):
+    return layout_dendrogram(clust).depths[0]
 
-        line_length = clust.distance * scaling
 
-        draw.line((x, top+h1 / 2, x, bottom - h2 / 2), fill=(255, 0, 0))
+def dendrogram_shapes(clust, labels, x, top, spacing, scaling,
+                      label_height=10, layout=None):
+    '''
+    Yields the lines and labels that draw the tree with its root at x
+    and its first leaf spacing / 2 below top:
+    ('line', (x1, y1, x2, y2), None) and ('text', (x, y), label).
+    Labels closer than label_height to the previous one are skipped,
+    so trees with more leaves than fit on the image stay readable.
+    layout is layout_dendrogram(clust), for callers that have it already.
+    '''
+    tree = layout if layout is not None else layout_dendrogram(clust)
+    index = dict((id(node), i) for i, node in enumerate(tree.nodes))
+    last_label = None
+
+    def node_x(i):
+        return x + (tree.offsets[i] - tree.offsets[0]) * scaling
+
+    def node_y(i):
+        return top + (tree.positions[i] - tree.positions[0] +
+                      tree.heights[0] / 2.0) * spacing
+
+    for i, node in enumerate(tree.nodes):
+        if node.id < 0:
+            left, right = index[id(node.left)], index[id(node.right)]
+            line_x = node_x(i)
+            child_x = line_x + node.distance * scaling
+            y1, y2 = node_y(left), node_y(right)
+
+            yield 'line', (line_x, y1, line_x, y2), None
+            yield 'line', (line_x, y1, child_x, y1), None
+            yield 'line', (line_x, y2, child_x, y2), None
+        else:
+            y = node_y(i)
+            if last_label is None or y - last_label >= label_height:
+                last_label = y
+                yield 'text', (node_x(i) + 5, y - 7), labels[node.id]
 
-        draw.line((x, top + h1 / 2, x + line_length, top + h1 / 2),
-                fill=(255, 0, 0))
 
-        draw.line((x, bottom - h2 / 2, x + line_length, bottom - h2 / 2),
-                fill=(255, 0, 0))
+def draw_node(draw, clust, x, y, scaling, labels):
+    '''
+    Draws the tree under clust with PIL, with its root at (x, y).
+    '''
+    top = y - get_height(clust) * 20 / 2.0
+    for kind, coords, label in dendrogram_shapes(clust, labels, x, top,
+                                                 20, scaling):
+        if kind == 'line':
+            draw.line(coords, fill=(255, 0, 0))
+        else:
+            draw.text(coords, label, (0, 0, 0))
 
-        draw_node(draw, clust.left, x + line_length, top + h1 / 2, scaling,
-                labels)
-        draw_node(draw, clust.right, x + line_length, bottom - h2 / 2, scaling,
-                labels)
-    else:
-        draw.text((x + 5, y - 7), labels[clust.id], (0, 0, 0))
 
+def draw_dendrogram(clust, labels, jpeg='clusters.jpg', width=1200,
+                    max_height=20000):
+    '''
+    Draws the tree to jpeg, or as SVG if the file name ends in .svg.
+    Every leaf gets 20 pixels, unless that makes the image taller than
+    max_height, in which case the leaves are squeezed together and only
+    as many labels as fit are drawn.
+    '''
+    tree = layout_dendrogram(clust)
+    leaves = tree.heights[0]
+    spacing = min(20.0, float(max_height) / leaves)
+    height = int(np.ceil(leaves * spacing))
+    depth = tree.depths[0]
 
-def draw_dendrogram(clust, labels, jpeg='clusters.jpg'):
-    height = get_height(clust) * 20
-    width = 1200
-    depth = get_depth(clust)
+    scaling = float(width - 150) / depth if depth else 0.0
+    shapes = dendrogram_shapes(clust, labels, 10, 0, spacing, scaling,
+                               layout=tree)
 
-    scaling = float(width - 150) / depth
+    if jpeg.endswith('.svg'):
+        write_svg(jpeg, width, height, shapes)
+        return
 
     img = Image.new('RGB', (width, height), (255, 255, 255))
     draw = ImageDraw.Draw(img)
 
     draw.line((0, height / 2, 10, height / 2), fill=(255, 0, 0))
 
-    draw_node(draw, clust, 10, (height / 2), scaling, labels)
+    for kind, coords, label in shapes:
+        if kind == 'line':
+            draw.line(coords, fill=(255, 0, 0))
+        else:
+            draw.text(coords, label, (0, 0, 0))
     img.save(jpeg, 'JPEG')
 
+
+def write_svg(file_name, width, height, shapes):
+    '''
+    Writes the shapes from dendrogram_shapes as an SVG image.
+    '''
+    from xml.sax.saxutils import escape
+
+    with open(file_name, 'wb') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" '
+                'height="%d">\n' % (width, height))
+        f.write('<rect width="100%" height="100%" fill="white"/>\n')
+        f.write('<g stroke="red" font-family="sans-serif" font-size="11">\n')
+        f.write('<line x1="0" y1="%.1f" x2="10" y2="%.1f"/>\n' %
+                (height / 2.0, height / 2.0))
+        for kind, coords, label in shapes:
+            if kind == 'line':
+                f.write('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f"/>\n'
+                        % coords)
+            else:
+                f.write('<text x="%.1f" y="%.1f" stroke="none" fill="black" '
+                        'dominant-baseline="hanging">%s</text>\n' %
+                        (coords[0], coords[1], escape(label)))
+        f.write('</g>\n</svg>\n')
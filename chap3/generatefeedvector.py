@@ -1,5 +1,25 @@
+from collections import namedtuple
 import feedparser
-import re
+import hashlib
+import os
+import Queue
+import shelve
+import sys
+import threading
+import urllib2
+from urlparse import urlparse
+
+try:
+    from tokenizer import LETTERS, Tokenizer
+except ImportError:
+    # run from the chapter directory without the repository root
+    # on PYTHONPATH, so look for the shared tokenizer one level up
+    sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..'))
+    from tokenizer import LETTERS, Tokenizer
+
+# words are runs of letters, anything inside tags is skipped
+feed_words = Tokenizer(LETTERS, strip_html=True)
 
 
 def get_word_counts(url):
@@ -8,8 +28,14 @@ def get_word_counts(url):
     Returns a tuple with a feed's title and
     a dictionary of word counts.
     '''
-    parsed = feedparser.parse(url)
+    return count_words(feedparser.parse(url))
 
+
+def count_words(parsed):
+    '''
+    Counts the words in the titles and summaries of an already
+    parsed feed. Returns the same tuple as get_word_counts.
+    '''
     word_count = {}
     if 'title' in parsed.feed:
 
@@ -19,8 +45,7 @@ def get_word_counts(url):
             else:
                 summary = entry.description
 
-            words = get_words(' '.join([entry.title, summary]))
-            for word in words:
+            for word in feed_words(' '.join([entry.title, summary])):
                 word_count.setdefault(word, 0)
                 word_count[word] += 1
 
@@ -31,55 +56,234 @@ def get_word_counts(url):
 
 def get_words(html):
     '''
-    Uses regular expressions to remove html tags and to split
-    the resulting text into single words.
+    Removes html tags and splits the resulting text into single words.
     Returns a list of lower cased words.
     '''
-    txt = re.compile(r'<[^>]+').sub('', html)
+    return list(feed_words(html))
 
-    words = re.compile(r'[^A-Z^a-z]+').split(txt)
 
-    return [word.lower() for word in words if word != '']
+# what a worker found at a url: the parsed feed, or parsed=None and the
+# exception in error, or neither when the feed hasn't changed since the
+# copy in the cache. etag, modified and digest are stored in the cache to
+# recognize the same feed next time.
+Fetched = namedtuple('Fetched', ['url', 'parsed', 'error', 'etag',
+                                 'modified', 'digest'])
 
 
-if __name__ == '__main__':
-    # turn into callable function for use in interactive python session
-    # break down into smaller functions for easier understanding
+def fetch(url, timeout=10, etag=None, modified=None):
+    '''
+    Downloads url and returns its body, its ETag and Last-Modified
+    headers and a dict of all the response headers (for feedparser to
+    pick the encoding from), giving up after timeout seconds without an
+    answer.
+    If etag or modified are given, the request is a conditional GET and
+    the body is None when the server answers 304 Not Modified.
+    '''
+    headers = {'User-Agent': 'generatefeedvector'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    request = urllib2.Request(url, headers=headers)
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return None, etag, modified, {}
+        raise
+    try:
+        headers = dict(response.info())
+        # what feedparser.parse(url) resolves relative links against
+        headers.setdefault('content-location', response.geturl())
+        return (response.read(), response.info().getheader('ETag'),
+                response.info().getheader('Last-Modified'), headers)
+    finally:
+        response.close()
+
+
+def fetch_feeds(urls, workers=8, per_host=2, timeout=10, cache=None):
+    '''
+    Downloads and parses the feeds at urls with a pool of worker threads,
+    never hitting the same host with more than per_host requests at once.
+    Yields a Fetched tuple for every url as soon as it's done, so the
+    caller can count words while the rest is downloading.
+    With a FeedCache, feeds are fetched with conditional GETs and feeds
+    that haven't changed aren't parsed again.
+    '''
+    urls = [url.strip() for url in urls if url.strip()]
+
+    # the shelf isn't safe to share between threads, so look up everything
+    # the workers need from it here
+    known = {}
+    if cache is not None:
+        for url in urls:
+            known[url] = cache.validators(url)
+
+    # one semaphore per host limits how many workers talk to it at once
+    hosts = {}
+    for url in urls:
+        host = urlparse(url).netloc
+        if host not in hosts:
+            hosts[host] = threading.BoundedSemaphore(per_host)
+
+    todo = Queue.Queue()
+    for url in urls:
+        todo.put(url)
+    done = Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                url = todo.get_nowait()
+            except Queue.Empty:
+                return
+            etag, modified, digest = known.get(url, (None, None, None))
+            # anything going wrong is reported, a worker that died would
+            # leave the caller waiting for its url forever
+            try:
+                with hosts[urlparse(url).netloc]:
+                    content, etag, modified, headers = fetch(
+                            url, timeout, etag, modified)
+
+                # servers without validators send the whole feed every
+                # time, but an unchanged body still doesn't need parsing
+                if content is not None:
+                    new_digest = hashlib.md5(content).hexdigest()
+                    if new_digest == digest:
+                        content = None
+                    digest = new_digest
+
+                parsed = None
+                if content is not None:
+                    parsed = feedparser.parse(content,
+                                              response_headers=headers)
+            except Exception as e:
+                done.put(Fetched(url, None, e, None, None, None))
+                continue
+            done.put(Fetched(url, parsed, None, etag, modified, digest))
+
+    threads = [threading.Thread(target=work)
+               for i in xrange(min(workers, len(urls)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for i in xrange(len(urls)):
+        yield done.get()
+
+    for thread in threads:
+        thread.join()
+
+
+class FeedCache(object):
+    '''
+    On-disk cache of feeds keyed by url. For every feed it keeps the
+    ETag and Last-Modified headers, a digest of the body and the title
+    and word counts count_words found in it, so a feed that hasn't
+    changed costs a 304 (or at worst a download) but no parsing.
+    '''
+    def __init__(self, file_name='feedcache.db'):
+        self.shelf = shelve.open(file_name)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.shelf is not None:
+            self.shelf.close()
+            self.shelf = None
+
+    def key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf8')
+        return url
+
+    def validators(self, url):
+        '''
+        Returns the (etag, modified, digest) stored for url, or Nones.
+        '''
+        entry = self.shelf.get(self.key(url))
+        if entry is None:
+            return None, None, None
+        return entry['etag'], entry['modified'], entry['digest']
+
+    def counts(self, url):
+        '''
+        Returns the stored (title, word counts) of url, like
+        get_word_counts would, or (None, None) if url isn't cached.
+        '''
+        entry = self.shelf.get(self.key(url))
+        if entry is None:
+            return None, None
+        return entry['title'], entry['word_count']
+
+    def store(self, url, etag, modified, digest, title, word_count):
+        self.shelf[self.key(url)] = {'etag': etag, 'modified': modified,
+                                     'digest': digest, 'title': title,
+                                     'word_count': word_count}
+
+
+def collect_word_counts(urls, workers=8, per_host=2, timeout=10, cache=None):
+    '''
+    Fetches the feeds at urls concurrently and counts their words as they
+    arrive. Returns a dictionary of title: word counts and a dictionary of
+    word: number of blogs using it more than once.
+    With a FeedCache, unchanged feeds reuse their cached counts, and so
+    do feeds that fail to download.
+    '''
     ap_count = {}
     word_counts = {}
 
-    # iterate through list of feed urls and collect word count for each feed
-    # then iterate throught that collection and assign the blog count for each word
-    with open('feedlist.txt', 'rb') as f:
-        feed_lines = f.readlines()
-        feed_list_length = len(feed_lines)
-        c = 0.0
-        for feed_url in feed_lines:
-            c += 1
-            print "%.2f%%" % ((c / feed_list_length) * 100)
-            title, word_count = get_word_counts(feed_url)
-            if title:
-                word_counts[title] = word_count
-
-                for word, count in word_count.items():
-                    ap_count.setdefault(word, 0)
-                    if count > 1:
-                        ap_count[word] += 1
+    urls = [url.strip() for url in urls if url.strip()]
+    c = 0.0
+    for fetched in fetch_feeds(urls, workers, per_host, timeout, cache):
+        c += 1
+        print "%.2f%%" % ((c / len(urls)) * 100)
+        if fetched.error is not None:
+            print 'Failed to fetch %s: %s' % (fetched.url, fetched.error)
+            if cache is None:
+                continue
+            title, word_count = cache.counts(fetched.url)
+        elif fetched.parsed is None:
+            title, word_count = cache.counts(fetched.url)
+        else:
+            title, word_count = count_words(fetched.parsed)
+            if cache is not None:
+                cache.store(fetched.url, fetched.etag, fetched.modified,
+                            fetched.digest, title, word_count)
 
-    word_list = []
+        if title:
+            word_counts[title] = word_count
+
+            for word, count in word_count.items():
+                ap_count.setdefault(word, 0)
+                if count > 1:
+                    ap_count[word] += 1
+
+    return word_counts, ap_count
 
-    # iterate through list of word:blog_count and find the fraction of
-    # how many times the word appears per all the blogs and if it's
-    # between 0.1 and 0.5 then append it to word_list
+
+def select_words(ap_count, blogs, low=0.1, high=0.5):
+    '''
+    Keeps the words that appear in more than low and less than high of
+    the blogs, the ones common enough to compare blogs but not so common
+    that every blog uses them.
+    '''
+    word_list = []
     for word, blog_count in ap_count.items():
-        frac = float(blog_count) / feed_list_length
-        if frac > 0.1 and frac < 0.5:
+        frac = float(blog_count) / blogs
+        if frac > low and frac < high:
             word_list.append(word)
+    return word_list
 
-    # first iterate through the word list and print out the tab separated
-    # list of words. Then iterate through the word_list again and if the word
-    # is in word_count, output it's count preceeded by a tab
-    with open('blogdata2.txt', 'wb') as output:
+
+def write_dense(file_name, word_counts, word_list):
+    '''
+    Writes the blogdata.txt format: a tab separated table with a row
+    per blog and a column per word, zeros included.
+    '''
+    with open(file_name, 'wb') as output:
         output.write('Blog')
         for word in word_list:
             output.write('\t%s' % word.encode('utf8'))
@@ -94,3 +298,56 @@ if __name__ == '__main__':
                 else:
                     output.write('\t0')
             output.write('\n')
+
+
+def write_sparse(file_name, word_counts, word_list):
+    '''
+    Writes only the nonzero counts, as a Matrix Market coordinate file
+    (file_name, ideally ending in .mtx) with the blog names in
+    file_name + '.rows' and the words in file_name + '.cols'.
+    The size grows with the number of counts instead of blogs x words,
+    and clusters.read_file and clusters.load_matrix read it.
+    '''
+    column = dict((word, i) for i, word in enumerate(word_list))
+
+    with open(file_name + '.cols', 'wb') as cols:
+        for word in word_list:
+            cols.write('%s\n' % word.encode('utf8'))
+
+    entries = []
+    with open(file_name + '.rows', 'wb') as rows:
+        for row, (blog, word_count) in enumerate(word_counts.items()):
+            rows.write('%s\n' % ' '.join(blog.encode('utf8').split()))
+            for word, count in word_count.items():
+                if word in column:
+                    entries.append('%d %d %d\n' % (row + 1, column[word] + 1,
+                                                   count))
+
+    # the matrix goes last, so a complete .mtx always has its sidecars
+    with open(file_name, 'wb') as output:
+        output.write('%%MatrixMarket matrix coordinate integer general\n')
+        output.write('%d %d %d\n' % (len(word_counts), len(word_list),
+                                     len(entries)))
+        output.writelines(entries)
+
+
+if __name__ == '__main__':
+    # the output file is blogdata2.txt, unless another one is given;
+    # names ending in .mtx get the sparse format
+    output_file = sys.argv[1] if len(sys.argv) > 1 else 'blogdata2.txt'
+
+    # fetch every feed in the list concurrently, collect the word count for
+    # each feed and the blog count for each word
+    with open('feedlist.txt', 'rb') as f:
+        feed_lines = [line.strip() for line in f if line.strip()]
+    # feeds that haven't changed since the last run come from the cache
+    cache = FeedCache('feedcache.db')
+    word_counts, ap_count = collect_word_counts(feed_lines, cache=cache)
+    cache.close()
+
+    word_list = select_words(ap_count, len(feed_lines))
+
+    if output_file.endswith('.mtx'):
+        write_sparse(output_file, word_counts, word_list)
+    else:
+        write_dense(output_file, word_counts, word_list)
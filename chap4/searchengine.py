@@ -1,25 +1,79 @@
 import urllib2
 from bs4 import BeautifulSoup
-from urlparse import urljoin
+from collections import deque
+from urlparse import urljoin, urlparse
 import sqlite3
-import re
 import nn
+import hashlib
+import math
+import numpy as np
+import os
+import Queue
+from scipy import sparse
+import struct
+import sys
+import threading
+import time
+
+try:
+    from tokenizer import Tokenizer
+except ImportError:
+    # run from the chapter directory without the repository root
+    # on PYTHONPATH, so look for the shared tokenizer one level up
+    sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..'))
+    from tokenizer import Tokenizer
 
 mynet = nn.SearchNet('nn.db')
 
+page_words = Tokenizer()
+
 ignore_words = {'the': 1, 'of': 1, 'to': 1, 'and': 1,
                 'a': 1, 'in': 1, 'is': 1, 'it': 1}
 
+# most words sent to sqlite in a single 'in (?, ?, ...)' query, well under
+# its limit of 999 parameters per statement
+SQL_BATCH = 500
+
 
 class Crawler(object):
     def __init__(self, dbname):
         self.con = sqlite3.connect(dbname)
+        # word: rowid in word_list, for every word committed so far
+        self.word_ids = {}
+        # words looked up or added since, cached by db_commit
+        self.new_words = set()
+        # Bloom filter of the indexed urls, loaded by is_indexed
+        self.indexed = None
+        # totals for index_stats
+        self.pages_indexed = 0
+        self.words_indexed = 0
+        self.index_time = 0.0
 
     def __del__(self):
         self.con.close()
 
     def db_commit(self):
         self.con.commit()
+        # the rowids are read again now that they can't be rolled back,
+        # since a rollback before this commit may have undone the ones
+        # get_word_ids saw
+        new_words = list(self.new_words)
+        self.new_words = set()
+        for start in xrange(0, len(new_words), SQL_BATCH):
+            self.word_ids.update(self.fetch_word_ids(
+                    new_words[start:start + SQL_BATCH]))
+
+    def index_stats(self):
+        '''
+        Returns how many pages and words add_to_index stored so far, and
+        how many of each per second it spent indexing.
+        '''
+        seconds = max(self.index_time, 1e-9)
+        return {'pages': self.pages_indexed, 'words': self.words_indexed,
+                'seconds': self.index_time,
+                'pages_per_sec': self.pages_indexed / seconds,
+                'words_per_sec': self.words_indexed / seconds}
 
     def get_entry_id(self, table, field, value, create_new=True):
         '''
@@ -27,43 +81,87 @@ class Crawler(object):
         entry in 'table' where 'field' equals 'value'.
         If it cannot find this entry, it creates it and returns the rowid.
         '''
-        cur = self.con.execute('select rowid from %s where %s=\'%s\'' %
-                (table, field, value))
+        cur = self.con.execute('select rowid from %s where %s=?' %
+                (table, field), (value,))
         result = cur.fetchone()
         if not result:
-            cur = self.con.execute('insert into %s (%s) values (\'%s\')' %
-                    (table, field, value))
+            cur = self.con.execute('insert into %s (%s) values (?)' %
+                    (table, field), (value,))
             return cur.lastrowid
         else:
             return result[0]
 
+    def get_word_ids(self, words):
+        '''
+        Returns a dict of word: rowid in word_list for every word in
+        words, adding the words that aren't in word_list yet. Words
+        committed before come from self.word_ids; the rest are looked up
+        and inserted in batches, rather than with a query per word.
+        '''
+        words = set(words)
+        word_ids = dict((word, self.word_ids[word]) for word in words
+                        if word in self.word_ids)
+        missing = [word for word in words if word not in word_ids]
+        for start in xrange(0, len(missing), SQL_BATCH):
+            batch = missing[start:start + SQL_BATCH]
+            word_ids.update(self.fetch_word_ids(batch))
+            new = [word for word in batch if word not in word_ids]
+            if new:
+                self.con.executemany('insert into word_list(word) values (?)',
+                                     [(word,) for word in new])
+                # executemany doesn't return the new rowids, so read them
+                word_ids.update(self.fetch_word_ids(new))
+        self.new_words.update(missing)
+        return word_ids
+
+    def fetch_word_ids(self, words):
+        '''
+        Returns a dict of word: rowid for the words in words that are in
+        word_list, using a single query.
+        '''
+        return dict(self.con.execute('select word, rowid from word_list '
+                                     'where word in (%s)' %
+                                     ','.join('?' * len(words)), words))
+
     def add_to_index(self, url, soup):
         '''
         Registers the url in the url_list, then registers every word
         (using soup) with it's url, word_id and location in the page.
+        All the words of the page are stored with a handful of batched
+        statements in the current transaction, which db_commit ends.
         '''
-        if self.is_indexed(url):
-            return
-
         #print 'Indexing %s' % url
-
         text = self.get_text_only(soup)
-        words = self.separate_words(text)
+        self.index_words(url, self.separate_words(text))
+
+    def index_words(self, url, words):
+        '''
+        The database half of add_to_index, for pages whose words were
+        already separated (by a crawl_concurrent worker, for instance).
+        Pages that are already indexed are skipped.
+        '''
+        if self.is_indexed(url):
+            return
+        start = time.time()
 
         # retrieves or sets and retrieves a url's rowid
         url_id = self.get_entry_id('url_list', 'url', url)
 
-        # iterates through all the words under a given url
-        for i in xrange(len(words)):
-            word = words[i]
-            if word in ignore_words:
-                continue
-            # retrieves or sets and retrieves a word's rowid
-            word_id = self.get_entry_id('word_list', 'word', word)
-            # record the url and word (by id) and location (by index of the
-            # in all the words on a page)
-            self.con.execute('insert into word_location(url_id, word_id, location) \
-                    values (%d, %d, %d)' % (url_id, word_id, i))
+        # the location of a word is its index in all the words on a page,
+        # ignored words included
+        locations = [(word, i) for i, word in enumerate(words)
+                     if word not in ignore_words]
+        word_ids = self.get_word_ids(word for word, i in locations)
+        self.con.executemany('insert into word_location(url_id, word_id, '
+                             'location) values (?, ?, ?)',
+                             [(url_id, word_ids[word], i)
+                              for word, i in locations])
+
+        if self.indexed is not None:
+            self.indexed.add(url)
+        self.pages_indexed += 1
+        self.words_indexed += len(locations)
+        self.index_time += time.time() - start
 
     def get_text_only(self, soup):
         '''
@@ -83,8 +181,7 @@ class Crawler(object):
         This function accepts a string and returns a list of lower-case
         words.
         '''
-        splitter = re.compile('\\W*')
-        return [s.lower() for s in splitter.split(text) if s != '']
+        return list(page_words(text))
 
     def is_indexed(self, url):
         '''
@@ -92,16 +189,34 @@ class Crawler(object):
         table and if yes, then further checks if an entry has been made
         in the word_location table for that url and if these two conditions
         are met - it returns True. Otherwise False.
+        Most urls a crawl asks about were never indexed, which a Bloom
+        filter of the indexed urls answers without touching the database.
         '''
-        u = self.con.execute('select rowid from url_list where url = \'%s\''
-                % url).fetchone()
+        if self.indexed is None:
+            self.load_indexed()
+        if url not in self.indexed:
+            return False
+
+        u = self.con.execute('select rowid from url_list where url = ?',
+                (url,)).fetchone()
         if u:
             v = self.con.execute('select * from word_location where url_id\
-                    =%d' % u[0]).fetchone()
+                    =?', (u[0],)).fetchone()
             if v:
                 return True
         return False
 
+    def load_indexed(self, capacity=1000000, error_rate=1e-4):
+        '''
+        Fills self.indexed with every url that has words in the index.
+        '''
+        urls = self.con.execute('select url from url_list where rowid in '
+                                '(select distinct url_id from word_location)'
+                                ).fetchall()
+        self.indexed = BloomFilter(max(capacity, 2 * len(urls)), error_rate)
+        for (url,) in urls:
+            self.indexed.add(url)
+
     def add_link_ref(self, url_from, url_to, link_text):
         '''
         This function uses the to and from urls to add an entry to the link
@@ -120,90 +235,415 @@ class Crawler(object):
                 'insert into link(from_id, to_id) values (%d, %d)' % \
                         (from_id, to_id))
         link_id = cur.lastrowid
-        for word in words:
-            if word in ignore_words:
-                continue
-            word_id = self.get_entry_id('word_list', 'word', word)
-            # add entry to the link_words table, which shows what words are
-            # associated with what links.
-            self.con.execute(
-                    'insert into link_words(link_id, word_id) values (%d, %d)'\
-                            % (link_id, word_id))
+        words = [word for word in words if word not in ignore_words]
+        word_ids = self.get_word_ids(words)
+        # add entries to the link_words table, which shows what words are
+        # associated with what links.
+        self.con.executemany(
+                'insert into link_words(link_id, word_id) values (?, ?)',
+                [(link_id, word_ids[word]) for word in words])
 
     def crawl(self, pages, depth=2):
         '''
         This function, given a list of urls, opens each url and then
         proceeds to process it and add it to the appropriate tables
         in the database.
+        It's crawl_concurrent with a single worker, committing after every
+        page, so the pages still to fetch are kept in the frontier table
+        and an interrupted crawl resumes where it stopped.
+        '''
+        self.crawl_concurrent(pages, depth, workers=1, batch_size=1)
+
+    def fetch_page(self, url, timeout=10):
+        '''
+        Downloads and parses url without touching the database, so it
+        can run in any thread. Returns the words of the page and a list
+        of (url, link text) tuples for the links on it that crawl would
+        follow.
+        '''
+        document = urllib2.urlopen(url, timeout=timeout)
+        try:
+            soup = BeautifulSoup(document.read())
+        finally:
+            document.close()
+        words = self.separate_words(self.get_text_only(soup))
+
+        links = []
+        for link in soup('a'):
+            if 'href' in dict(link.attrs):
+                link_url = urljoin(url, link['href'])
+                # skip urls with a single quote mark, like crawl does
+                if link_url.find("'") != -1:
+                    continue
+                link_url = link_url.split("#")[0]
+                if link_url[0:4] == 'file' or link_url[0:4] == 'http':
+                    links.append((link_url, self.get_text_only(link)))
+        return words, links
+
+    def crawl_concurrent(self, pages, depth=2, workers=8, per_host=2,
+                         delay=0.0, timeout=10, batch_size=50, retries=2):
+        '''
+        Concurrent version of crawl. A pool of worker threads downloads
+        and parses pages (at most per_host at a time from the same host,
+        starting at least delay seconds apart), while this thread, the
+        only one that uses the database connection, indexes what they
+        found and commits every batch_size pages.
+        Pages are fetched shallowest first: depth 0 are the given pages,
+        depth 1 the pages they link to, and so on up to depth - 1, like
+        the levels crawl goes through, so nothing is fetched when depth
+        is 0 or less.
+        A page that can't be fetched is queued again up to retries times,
+        then dropped from the frontier, so a later crawl that finds it
+        tries again.
+        The pages still to fetch are kept in the database (see Frontier),
+        so a crawl that was interrupted carries on where it stopped the
+        next time this is called, with the same or no pages.
         '''
-        for i in xrange(depth):
-            new_pages = set()
-            for page in pages:
+        if depth <= 0:
+            return
+        limits = HostLimits(per_host, delay)
+        frontier = Frontier(self.con)
+        todo = Queue.Queue()
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                url, level = todo.get()
+                if url is None:
+                    return
+                host = urlparse(url).netloc
+                limits.acquire(host)
                 try:
-                    document = urllib2.urlopen(page)
-                except:
-                    print "Could not open %s page" % page
+                    words, links = self.fetch_page(url, timeout)
+                    results.put((url, level, words, links, None))
+                except Exception as e:
+                    results.put((url, level, None, None, e))
+                finally:
+                    limits.release(host)
+
+        threads = [threading.Thread(target=work) for i in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # the given pages are queued even if they were queued before
+        frontier.push([(url, 0) for url in pages if not self.is_indexed(url)],
+                      requeue=True)
+
+        # keep a few pages per worker in memory, the rest wait on disk
+        in_flight = 0
+        done = 0
+        failures = {}
+        try:
+            while True:
+                for url, level in frontier.take(workers * 4 - in_flight):
+                    todo.put((url, level))
+                    in_flight += 1
+                if not in_flight:
+                    break
+
+                url, level, words, links, error = results.get()
+                in_flight -= 1
+                if error is not None:
+                    failures[url] = failures.get(url, 0) + 1
+                    if failures[url] <= retries:
+                        frontier.retry(url)
+                    else:
+                        print "Could not open %s page" % url
+                        frontier.forget(url)
                     continue
-                soup = BeautifulSoup(document.read())
-                # process a page and record the findings in the db
-                self.add_to_index(page, soup)
-
-                # scrape all the links from the page
-                links = soup('a')
-                for link in links:
-                    if 'href' in dict(link.attrs):
-                        # use urlpar.urljoin to combine user-provided
-                        # absolute url and the anchor address scraped.
-                        url = urljoin(page, link['href'])
-                        # continue loop if a single quote mark is in the url
-                        if url.find("'") != -1:
-                            continue
-                        url = url.split("#")[0]
-                        if url[0:4] == 'file' or url[0:4] == 'http' and not self.is_indexed(url):
-                            # if the url hasnt been indexed yet, then add it
-                            # to the new_pages set. Using a set ensures that
-                            # there will be no duplicates
-                            new_pages.add(url)
-                            link_text = self.get_text_only(link)
-                            # use the current page url (page), the linked
-                            # url (url), and the link text to add an entry
-                            # to the link_words table
-                            self.add_link_ref(page, url, link_text)
-                self.db_commit()
-
-                pages = new_pages
-
-    def calculate_page_rank(self, iterations=20):
-        self.con.execute('drop table if exists page_rank')
-        self.con.execute('create table page_rank(url_id primary key, score)')
 
-        self.con.execute(
-                'insert into page_rank select rowid, 1.0 from url_list')
+                self.index_words(url, words)
+                new_pages = []
+                for link_url, link_text in links:
+                    if self.is_indexed(link_url):
+                        continue
+                    if level + 1 < depth:
+                        new_pages.append((link_url, level + 1))
+                    self.add_link_ref(url, link_url, link_text)
+                frontier.push(new_pages)
+                frontier.finish(url)
+
+                done += 1
+                if done % batch_size == 0:
+                    self.db_commit()
+            self.db_commit()
+        except:
+            # drop the unfinished batch, its pages are still queued in the
+            # database and get fetched again when the crawl resumes
+            self.con.rollback()
+            raise
+        finally:
+            # a None url tells a worker to stop, after every real page
+            for thread in threads:
+                todo.put((None, None))
+            for thread in threads:
+                thread.join()
+
+        stats = self.index_stats()
+        print ('Indexed %d pages, %d words in %.2f s (%.1f pages/s, '
+               '%.1f words/s)' % (stats['pages'], stats['words'],
+                                  stats['seconds'], stats['pages_per_sec'],
+                                  stats['words_per_sec']))
+
+    def load_link_graph(self):
+        '''
+        Reads the link table once and returns the url_list rowids (sorted)
+        and a CSR adjacency matrix with a 1 at [i, j] when the page at
+        position i links to the page at position j. Repeated links
+        between the same two pages count once.
+        '''
+        url_ids = np.array([row[0] for row in self.con.execute(
+                'select rowid from url_list order by rowid')], dtype=np.int64)
+        links = np.array(self.con.execute(
+                'select distinct from_id, to_id from link').fetchall(),
+                dtype=np.int64).reshape(-1, 2)
+
+        # keep only links between known urls, then turn rowids into rows
+        rows = np.searchsorted(url_ids, links[:, 0])
+        cols = np.searchsorted(url_ids, links[:, 1])
+        known = ((rows < len(url_ids)) & (cols < len(url_ids)))
+        known[known] = ((url_ids[rows[known]] == links[known, 0]) &
+                        (url_ids[cols[known]] == links[known, 1]))
+        graph = sparse.csr_matrix((np.ones(known.sum()),
+                                   (rows[known], cols[known])),
+                                  shape=(len(url_ids), len(url_ids)))
+        return url_ids, graph
+
+    def calculate_page_rank(self, iterations=100, damping=0.85, tol=1e-8):
+        '''
+        Computes the PageRank of every url with power iteration over the
+        whole link graph in memory, and stores it in the page_rank table.
+        Every page gets (1 - damping) plus damping times the rank of the
+        pages linking to it, each divided by their number of outgoing
+        links. Pages without outgoing links share their rank with every
+        page, so the ranks always add up to the number of pages.
+        Stops after iterations rounds, or as soon as no rank moves more
+        than tol on average.
+        Also records what update_page_rank needs to carry on from here.
+        '''
+        last_url = self.last_rowid('url_list')
+        last_link = self.last_rowid('link')
+        url_ids, graph = self.load_link_graph()
+        transition, dangling = page_rank_transition(graph)
+        n = len(url_ids)
+
+        scores = np.ones(n)
+        done = 0
+        while done < iterations:
+            new_scores = ((1 - damping) +
+                          damping * (transition.dot(scores) +
+                                     scores[dangling].sum() / n))
+            change = np.abs(new_scores - scores).sum()
+            scores = new_scores
+            done += 1
+            if change <= tol * n:
+                break
+        print 'PageRank: %d iterations' % done
+
+        self.save_page_rank(url_ids, scores)
+        self.save_page_rank_state(damping, n, scores[dangling].sum(), 1.0,
+                                  last_url, last_link)
         self.db_commit()
 
-        for i in xrange(iterations):
-            print 'Iteration: %d' % i
-            for (url_id,) in self.con.execute('select rowid from url_list'):
-                pr = 0.15
+    def update_page_rank(self, damping=0.85, tol=1e-6,
+                         recompute_fraction=0.05):
+        '''
+        Brings the page_rank table up to date after a (partial) recrawl
+        without starting over. The urls and links added since the last
+        run are the ones past the rowids it recorded; only the links of
+        the pages they touch are read. Every page has a residual, how
+        far its rank is from what its linkers say it should be: the
+        changes set the residuals of the pages involved, which are then
+        pushed page by page to the pages they link to, until none is
+        off by more than tol. The residuals left over are kept in the
+        page_rank_residual table for the next run.
+        What the pages without links out spread to every page is never
+        pushed: the same residual on every page is fixed by multiplying
+        all the ranks by a common factor, kept as the scale in the
+        page_rank_state table. The page_rank table holds the ranks
+        divided by it, which the searcher, that only compares ranks,
+        doesn't notice.
+        Falls back to calculate_page_rank if that never ran (or ran with
+        another damping), if more than recompute_fraction of the pages
+        changed, or once the change has spread far enough to take more
+        pushes than a quarter of the pages, when pushing would cost more
+        than starting over.
+        '''
+        state = self.load_page_rank_state()
+        if state is None or not state['pages'] or state['damping'] != damping:
+            return self.calculate_page_rank(damping=damping)
+        last_url = self.last_rowid('url_list')
+        last_link = self.last_rowid('link')
+        new_urls = [row[0] for row in self.con.execute(
+                'select rowid from url_list where rowid > ? and rowid <= ?',
+                (state['last_url'], last_url))]
+        linking = [row[0] for row in self.con.execute(
+                'select distinct from_id from link where rowid > ? and '
+                'rowid <= ?', (state['last_link'], last_link))]
+        n = state['pages'] + len(new_urls)
+        if len(new_urls) + len(linking) > recompute_fraction * n:
+            return self.calculate_page_rank(damping=damping)
 
-                for (linker,) in self.con.execute(
-                        'select distinct from_id from link where to_id=%d' % \
-                                url_id):
-                    linking_pr = self.con.execute(
-                            'select score from page_rank where url_id=%d' % \
-                                    linker).fetchone()[0]
+        # everything below is divided by scale, like the page_rank table
+        scale = state['scale']
+        dangling = state['dangling']
+        scores = {}
+        residuals = {}
+        links = {}
+
+        def score(page):
+            if page not in scores:
+                row = self.con.execute('select score from page_rank where '
+                                       'url_id=?', (page,)).fetchone()
+                scores[page] = row[0] if row else 1.0 / scale
+            return scores[page]
+
+        def residual(page):
+            if page not in residuals:
+                row = self.con.execute('select residual from '
+                                       'page_rank_residual where url_id=?',
+                                       (page,)).fetchone()
+                residuals[page] = row[0] if row else 0.0
+            return residuals[page]
+
+        def page_links(page):
+            if page not in links:
+                links[page] = self.page_links(page)
+            return links[page]
+
+        # new pages start at 1 without links out, so they add to what the
+        # pages without links out share with everyone; the change of
+        # that share is the same for every page (uniform)
+        share = damping * dangling / state['pages']
+        for page in new_urls:
+            scores[page] = 1.0 / scale
+            residuals[page] = share - damping / scale
+        dangling += len(new_urls) / scale
+        uniform = damping * dangling / n - share
 
-                    linking_count = self.con.execute(
-                            'select count(*) from link where from_id=%d' % \
-                                    linker).fetchone()[0]
-                    pr += 0.85 * (linking_pr / linking_count)
+        # a page with new links takes its rank from the pages it linked
+        # to before (or from everyone, if it had no links) and spreads it
+        # over all the pages it links to now
+        for page in linking:
+            old = self.page_links(page, state['last_link'])
+            push = damping * score(page)
+            if old:
+                for target in old:
+                    residuals[target] = residual(target) - push / len(old)
+            else:
+                dangling -= score(page)
+                uniform -= push / n
+            for target in page_links(page):
+                residuals[target] = (residual(target) +
+                                     push / len(page_links(page)))
 
-                self.con.execute(
-                        'update page_rank set score=%f where url_id=%d' % \
-                            (pr, url_id))
+        # uniform * scale on every page is what makes the ranks off by
+        # a factor of (1 - damping) / (1 - damping - uniform * scale)
+        scale *= (1 - damping) / (1 - damping - uniform * scale)
 
+        queue = deque(page for page in residuals
+                      if abs(residuals[page] * scale) > tol)
+        queued = set(queue)
+        pushes = 0
+        while queue:
+            page = queue.popleft()
+            queued.discard(page)
+            push = residual(page)
+            if abs(push * scale) <= tol:
+                continue
+            scores[page] = score(page) + push
+            residuals[page] = 0.0
+            pushes += 1
+            if pushes > n / 4:
+                # nothing was written yet
+                return self.calculate_page_rank(damping=damping)
+
+            targets = page_links(page)
+            if not targets:
+                dangling += push
+                scale *= (1 - damping) / (1 - damping -
+                                          damping * push * scale / n)
+                continue
+            for target in targets:
+                residuals[target] = (residual(target) +
+                                     damping * push / len(targets))
+                if (target not in queued and
+                        abs(residuals[target] * scale) > tol):
+                    queued.add(target)
+                    queue.append(target)
+        print 'PageRank: %d changed pages, %d pushes' % (
+                len(new_urls) + len(linking), pushes)
+
+        self.con.executemany('insert or replace into page_rank(url_id, score) '
+                             'values (?, ?)', scores.items())
+        self.con.executemany('insert or replace into page_rank_residual('
+                             'url_id, residual) values (?, ?)',
+                             residuals.items())
+        self.save_page_rank_state(damping, n, dangling, scale, last_url,
+                                  last_link)
         self.db_commit()
 
+    def last_rowid(self, table):
+        return self.con.execute('select max(rowid) from %s' %
+                                table).fetchone()[0] or 0
+
+    def page_links(self, url_id, last_link=None):
+        '''
+        Returns the url_ids the page at url_id links to, each once. With
+        last_link, only the links up to that rowid in the link table.
+        '''
+        if last_link is None:
+            cur = self.con.execute('select distinct to_id from link where '
+                                   'from_id=?', (url_id,))
+        else:
+            cur = self.con.execute('select distinct to_id from link where '
+                                   'from_id=? and rowid <= ?',
+                                   (url_id, last_link))
+        return [row[0] for row in cur]
+
+    def save_page_rank(self, url_ids, scores):
+        self.con.execute('drop table if exists page_rank')
+        self.con.execute('create table page_rank(url_id primary key, score)')
+        self.con.executemany('insert into page_rank(url_id, score) '
+                             'values (?, ?)',
+                             zip(url_ids.tolist(), scores.tolist()))
+        self.con.execute('drop table if exists page_rank_residual')
+        self.con.execute('create table page_rank_residual(url_id primary '
+                         'key, residual)')
+
+    def load_page_rank_state(self):
+        '''
+        Returns what the last calculate_page_rank or update_page_rank
+        recorded as a dict, or None if neither ran yet.
+        '''
+        if not self.con.execute('select name from sqlite_master where '
+                                'type=\'table\' and name=\'page_rank_state\''
+                                ).fetchone():
+            return None
+        row = self.con.execute('select damping, pages, dangling, scale, '
+                               'last_url, last_link from page_rank_state'
+                               ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('damping', 'pages', 'dangling', 'scale',
+                         'last_url', 'last_link'), row))
+
+    def save_page_rank_state(self, damping, pages, dangling, scale,
+                             last_url, last_link):
+        '''
+        Records the damping, number of pages, rank of the pages without
+        links out (divided by scale), scale and the last url_list and
+        link rowids the page_rank table accounts for.
+        '''
+        self.con.execute('create table if not exists page_rank_state('
+                         'damping, pages, dangling, scale, last_url, '
+                         'last_link)')
+        self.con.execute('delete from page_rank_state')
+        self.con.execute('insert into page_rank_state values (?, ?, ?, ?, '
+                         '?, ?)', (damping, pages, float(dangling), scale,
+                                   last_url, last_link))
+
     def create_index_tables(self):
         self.con.execute('create table url_list(url)')
         self.con.execute('create table word_list(word)')
@@ -218,6 +658,183 @@ class Crawler(object):
         self.db_commit()
 
 
+def page_rank_transition(graph):
+    '''
+    Turns an adjacency matrix into the matrix PageRank multiplies the
+    scores with: [j, i] is 1 / (number of links out of i) when i links
+    to j. Also returns the positions of the pages with no links out.
+    '''
+    out_links = np.asarray(graph.sum(axis=1)).ravel()
+    dangling = np.flatnonzero(out_links == 0)
+    weights = sparse.diags(1.0 / np.maximum(out_links, 1))
+    return sparse.csr_matrix((weights * graph).T), dangling
+
+
+class BloomFilter(object):
+    '''
+    Set of strings that fits millions of urls in a few MB, at the price
+    of answering "maybe" instead of "yes": a string that was added is
+    always found, one that wasn't is wrongly found with a probability
+    below error_rate.
+    The filter grows as needed: every time the newest bit array holds
+    as many strings as it was sized for, another one twice as large,
+    with half the error rate, is added. The error rates of all of them
+    add up to less than error_rate however many strings are added.
+    '''
+    def __init__(self, capacity, error_rate=1e-4):
+        # (size in bits, number of hashes, bits) of every stage
+        self.stages = []
+        self.capacity = capacity
+        self.error_rate = error_rate / 2
+        self.count = 0
+        self.add_stage()
+
+    def add_stage(self):
+        size = max(8, int(math.ceil(-self.capacity *
+                                    math.log(self.error_rate) /
+                                    math.log(2) ** 2)))
+        hashes = max(1, int(round(float(size) / self.capacity *
+                                  math.log(2))))
+        self.stages.append((size, hashes, bytearray((size + 7) // 8)))
+
+    def hashes(self, key):
+        # the two halves of an md5 digest, combined as h1 + i * h2, give
+        # as many independent looking hashes as needed
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return struct.unpack('<QQ', hashlib.md5(key).digest())
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.capacity *= 2
+            self.error_rate /= 2
+            self.count = 0
+            self.add_stage()
+        h1, h2 = self.hashes(key)
+        size, hashes, bits = self.stages[-1]
+        for i in xrange(hashes):
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        h1, h2 = self.hashes(key)
+        for size, hashes, bits in self.stages:
+            for i in xrange(hashes):
+                position = (h1 + i * h2) % size
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+
+class Frontier(object):
+    '''
+    Queue of the pages crawl_concurrent still has to fetch, stored in the
+    frontier table so it survives restarts. Every url found in links is
+    queued once: its row stays after it's fetched, and a Bloom filter of
+    all the queued urls keeps links to known pages from reaching the
+    database. The pages a crawl starts from are queued again whenever
+    they're given, and pages that couldn't be fetched are forgotten.
+    (A new url that the filter mistakes for a known one, less than one
+    in 1 / error_rate, isn't queued.)
+    '''
+    QUEUED = 0
+    TAKEN = 1
+    DONE = 2
+
+    def __init__(self, con, capacity=1000000, error_rate=1e-4):
+        self.con = con
+        self.con.execute('create table if not exists frontier(url primary '
+                         'key, depth integer, state integer)')
+        self.con.execute('create index if not exists frontier_state_idx on '
+                         'frontier(state, depth)')
+        # pages that were being fetched when the last crawl stopped
+        self.con.execute('update frontier set state=? where state=?',
+                         (self.QUEUED, self.TAKEN))
+
+        urls = self.con.execute('select url from frontier').fetchall()
+        self.seen = BloomFilter(max(capacity, 2 * len(urls)), error_rate)
+        for (url,) in urls:
+            self.seen.add(url)
+
+    def push(self, pages, requeue=False):
+        '''
+        Queues the (url, depth) tuples in pages that were never queued.
+        With requeue, the ones that were are queued again too.
+        '''
+        new = []
+        for url, depth in pages:
+            if requeue or url not in self.seen:
+                self.seen.add(url)
+                new.append((url, depth, self.QUEUED))
+        self.con.executemany('insert or %s into frontier(url, depth, state) '
+                             'values (?, ?, ?)' %
+                             ('replace' if requeue else 'ignore'), new)
+
+    def take(self, n):
+        '''
+        Returns up to n queued (url, depth) tuples, shallowest first, and
+        marks them as being fetched.
+        '''
+        if n <= 0:
+            return []
+        pages = self.con.execute('select url, depth from frontier where '
+                                 'state=? order by depth, rowid limit ?',
+                                 (self.QUEUED, n)).fetchall()
+        self.con.executemany('update frontier set state=? where url=?',
+                             [(self.TAKEN, url) for url, depth in pages])
+        return pages
+
+    def finish(self, url):
+        self.con.execute('update frontier set state=? where url=?',
+                         (self.DONE, url))
+
+    def retry(self, url):
+        self.con.execute('update frontier set state=? where url=?',
+                         (self.QUEUED, url))
+
+    def forget(self, url):
+        '''
+        Drops url from the frontier. It stays in the Bloom filter until
+        the next Frontier is made, so the rest of this crawl doesn't
+        queue it again, but later crawls do.
+        '''
+        self.con.execute('delete from frontier where url=?', (url,))
+
+
+class HostLimits(object):
+    '''
+    Politeness limits for crawl_concurrent: at most per_host requests
+    to the same host at once, started at least delay seconds apart.
+    '''
+    def __init__(self, per_host=2, delay=0.0):
+        self.per_host = per_host
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.next_start = {}
+
+    def acquire(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.per_host)
+            slots = self.slots[host]
+        slots.acquire()
+
+        # book the next free start time for this host, then wait for it
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, host):
+        self.slots[host].release()
+
+
 class Searcher(object):
     def __init__(self, db_name):
         self.con = sqlite3.connect(db_name)
@@ -1,6 +1,19 @@
-import re
 import math
+import os
 import sqlite3
+import sys
+
+try:
+    from tokenizer import Tokenizer
+except ImportError:
+    # run from the chapter directory without the repository root
+    # on PYTHONPATH, so look for the shared tokenizer one level up
+    sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..'))
+    from tokenizer import Tokenizer
+
+# words longer than 2 chars and shorter than 20
+doc_words = Tokenizer(min_length=3, max_length=19)
 
 
 def get_words(doc):
@@ -8,11 +21,7 @@ def get_words(doc):
     This is a helper function that splits a string into
     words that are longer than 2 chars and shorter than 20.
     '''
-    splitter = re.compile('\\W*')
-    words = [s.lower() for s in splitter.split(doc)
-                if len(s) > 2 and len(s) < 20]
-
-    return dict([(w, 1) for w in words])
+    return dict((w, 1) for w in doc_words(doc))
 
 
 class Classifier(object):
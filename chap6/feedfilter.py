@@ -1,5 +1,18 @@
 import feedparser
-import re
+import os
+import sys
+
+try:
+    from tokenizer import Tokenizer
+except ImportError:
+    # run from the chapter directory without the repository root
+    # on PYTHONPATH, so look for the shared tokenizer one level up
+    sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..'))
+    from tokenizer import Tokenizer
+
+entry_words = Tokenizer(min_length=3, max_length=19)
+
 
 def read(feed, classifier):
     '''
@@ -33,16 +46,12 @@ def entry_features(entry):
     a dictionary (f) of features that include the title,
     summary, publisher, and even upper case words!
     '''
-    splitter = re.compile('\\W*')
     f = {}
 
-    title_words = [s.lower() for s in splitter.split(entry['title'])
-            if len(s) > 2 and len(s) < 20]
-    for word in title_words:
+    for word in entry_words(entry['title']):
         f['Title:' + word] = 1
 
-    summary_words = [s.lower() for s in splitter.split(entry['summary'])
-            if len(s) > 2 and len(s) < 20]
+    summary_words = list(entry_words(entry['summary']))
 
     upper_case = 0
     for i in xrange(len(summary_words)):